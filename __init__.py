@@ -1,4 +1,25 @@
-from .client import ClientConnectionPool
-from .client import ExtendChannel
-from .manager import Manager
-from .callback_handler import DefaultCallBackHandler
+# 按需导入，import本包时不加载grpc和yaml
+_lazy_attrs = {
+    "ClientConnectionPool": ".client",
+    "ExtendChannel": ".client",
+    "Manager": ".manager",
+    "DefaultCallBackHandler": ".callback_handler",
+    "deadline": ".timeouts",
+}
+
+__all__ = list(_lazy_attrs)
+
+
+def __getattr__(name):
+    module = _lazy_attrs.get(name)
+    if module is None:
+        raise AttributeError("module %r has no attribute %r" % (__name__, name))
+    import importlib
+
+    value = getattr(importlib.import_module(module, __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
@@ -0,0 +1,402 @@
+"""
+基于grpc.aio的异步连接池，接口与同步版本保持一致，stub方法返回可await的调用对象
+"""
+import asyncio
+from time import monotonic, perf_counter
+
+from grpc import aio, StatusCode
+
+from .client import ClientConnectionPool, ExtendChannel, MethodProxy
+from .errors import status_code
+from .manager import Manager
+from .reconnect import backoff_delay
+
+
+class AsyncMethodProxy(MethodProxy):
+    """
+    grpc.aio的方法调用立即返回调用对象，调用完成时才减少正在处理的请求数并记录延迟
+    """
+    __slots__ = ()
+
+    @staticmethod
+    def invoke(channel, method, args, kwargs, name=None):
+        channel.acquire()
+        start = perf_counter()
+        try:
+            call = method(*args, **kwargs)
+        except Exception as e:
+            channel.release(perf_counter() - start, False, status_code(e), name)
+            raise
+
+        def done(c):
+            if c.cancelled():
+                channel.release(None)
+                return
+            latency = perf_counter() - start
+            # aio的code()是协程，调用已结束，下一轮事件循环即可拿到结果
+            code = asyncio.ensure_future(c.code())
+
+            def finish(f):
+                result = None if f.cancelled() or f.exception() is not None else f.result()
+                channel.release(latency, result == StatusCode.OK, result, name)
+            code.add_done_callback(finish)
+
+        call.add_done_callback(done)
+        return call
+
+    @staticmethod
+    def invoke_with_call(channel, method, args, kwargs, name=None):
+        # grpc.aio的方法没有with_call，调用对象本身就可以await并取得code()/trailing_metadata()
+        raise TypeError("with_call is not supported by grpc.aio, await the call object instead")
+
+    @staticmethod
+    def invoke_future(channel, method, args, kwargs, name=None):
+        raise TypeError("future is not supported by grpc.aio, the call object is already awaitable")
+
+
+class _UnboundChannel(object):
+    """
+    还没有创建grpc.aio channel时用来初始化stub，只为了拿到stub的方法名
+    """
+
+    def _method(self, *args, **kwargs):
+        return None
+
+    unary_unary = unary_stream = stream_unary = stream_stream = _method
+
+
+class AsyncExtendChannel(ExtendChannel):
+    """
+    grpc.aio channel没有subscribe，用事件循环上的任务监听连接状态
+    grpc.aio channel绑定到创建时的事件循环，没有运行中的事件循环时推迟到第一次取连接时创建
+    """
+
+    def __init__(self, *args, **kwargs):
+        self._watcher = None
+        self._reconnect_handle = None
+        self._loop = None
+        super(AsyncExtendChannel, self).__init__(*args, **kwargs)
+
+    def connect(self):
+        """
+        在当前运行的事件循环中连接，没有运行中的事件循环时返回None
+        :return:
+        """
+        try:
+            self._loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return None
+        MB = 1024 * 1024
+        GRPC_CHANNEL_OPTIONS = [('grpc.max_message_length', 64 * MB), ('grpc.max_receive_message_length', 64 * MB)]
+
+        interceptors = None
+        if self.intercept:
+            interceptors = self.intercept if isinstance(self.intercept, (list, tuple)) else [self.intercept]
+        return aio.insecure_channel("{}:{}".format(self.host, self.port), options=GRPC_CHANNEL_OPTIONS,
+                                    interceptors=interceptors)
+
+    def watch(self, channel, try_to_connect=False):
+        """
+        在channel所在的事件循环中启动状态监听任务
+        :param channel: grpc.aio channel，为None时不监听
+        :param try_to_connect: 是否立即开始连接
+        :return:
+        """
+        if channel is None:
+            return
+        self._watcher = self._loop.create_task(self._watch(channel, try_to_connect))
+
+    def init_stub(self, stub_cls):
+        if self._channel is not None:
+            return super(AsyncExtendChannel, self).init_stub(stub_cls)
+        temp = stub_cls(_UnboundChannel())
+        self.stub_methods = {}
+        if self.pool:
+            for k in temp.__dict__:
+                if not k.startswith("__"):
+                    self.pool.methods.add(k)
+        return None
+
+    def bind(self, loop):
+        """
+        在loop中创建grpc.aio channel并开始监听状态，已经在loop中创建过时什么都不做
+        之前的事件循环已关闭(如多次asyncio.run)时重新创建，仍在运行时抛出RuntimeError
+        asyncio.run结束时取消监听任务，旧channel在那时已经关闭，见_watch
+        :param loop: 当前运行的事件循环
+        :return:
+        """
+        if self._loop is loop or self._state == "DEPRECATED":
+            return
+        if self._loop is not None and not self._loop.is_closed():
+            raise RuntimeError("Channel %s is bound to another running event loop" % self.name)
+        old = self._channel
+        self._watcher = None
+        self._reconnect_handle = None
+        self.reconnect_pending = False
+        self._channel = self.connect()
+        self.watch(self._channel)
+        if self.stub_cls:
+            self.stub = self.init_stub(self.stub_cls)
+        if old is not None:
+            asyncio.ensure_future(old.close())
+
+    def unwatch(self, channel):
+        if self._watcher is not None:
+            self._watcher.cancel()
+            self._watcher = None
+
+    async def _watch(self, channel, try_to_connect):
+        try:
+            state = channel.get_state(try_to_connect=try_to_connect)
+            while self._channel is channel and self._state != "DEPRECATED":
+                self.callback(state)
+                await channel.wait_for_state_change(state)
+                state = channel.get_state()
+        except asyncio.CancelledError:
+            # 不是unwatch取消的(asyncio.run结束时取消所有任务)，在事件循环关闭前关闭channel，下一个事件循环中重新创建
+            if self._watcher is not None and self._channel is channel:
+                self._watcher = None
+                self._channel = None
+                # stub的方法也引用着channel，全部释放后grpc才会停止在这个事件循环上的轮询
+                self.stub = None
+                self.stub_methods = {}
+                await channel.close()
+            raise
+
+    def schedule_reconnect(self):
+        """
+        用事件循环的定时器重连，不占用额外线程
+        :return:
+        """
+        if self._state == "DEPRECATED" or self.reconnect_pending:
+            return
+        if self.pool:
+            delay = self.pool.reconnect_delay(self.reconnect_attempts)
+        else:
+            delay = backoff_delay(self.reconnect_attempts, self.reconnect_loop_time)
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        self.reconnect_pending = True
+        self.reconnect_attempts += 1
+        self._reconnect_handle = loop.call_later(delay, self.reconnect)
+
+    def reconnect(self):
+        """
+        重新连接，旧channel在后台关闭
+        :return:
+        """
+        self.reconnect_pending = False
+        self._reconnect_handle = None
+        if self._state == "DEPRECATED":
+            return
+        old = self._channel
+        self.unwatch(old)
+        self._channel = self.connect()
+        self.watch(self._channel, try_to_connect=True)
+        if self.stub_cls:
+            self.stub = self.init_stub(self.stub_cls)
+        asyncio.ensure_future(old.close())
+
+    def close(self):
+        """
+        关闭，返回可await的关闭任务，没有运行中的事件循环时返回None
+        :return:
+        """
+        self._set_state("DEPRECATED")
+        if self._reconnect_handle is not None:
+            self._reconnect_handle.cancel()
+            self._reconnect_handle = None
+        self.unwatch(self._channel)
+        if self._channel is None:
+            return None
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return None
+        return asyncio.ensure_future(self._channel.close())
+
+
+class AsyncClientConnectionPool(ClientConnectionPool):
+    """
+    异步客户端连接池，所有操作都在同一个事件循环中进行，取连接不加锁
+    """
+    channel_cls = AsyncExtendChannel
+    method_proxy_cls = AsyncMethodProxy
+    # 同步调用链的配置，异步调用直接发送，见build_call
+    unsupported_options = ("cache", "coalesce", "batch", "retry", "hedge")
+
+    def __init__(self, *args, **kwargs):
+        unsupported = [k for k in self.unsupported_options if kwargs.get(k)]
+        if unsupported:
+            raise Exception("%s not supported by %s" % (", ".join(unsupported), self.__class__.__name__))
+        # 重连由事件循环调度，不需要重连线程
+        kwargs.pop("reconnect_scheduler", None)
+        self._loop = None
+        # 正在等待关闭被删除连接的任务，保留引用避免任务被回收
+        self._drainers = set()
+        super(AsyncClientConnectionPool, self).__init__(*args, **kwargs)
+
+    def get_one_connection(self, timeout=None):
+        """
+        随机获取一个连接对象，第一次调用时在当前事件循环中创建连接并启动状态监听
+        事件循环中不能阻塞等待，没有可用连接时总是立即抛出BlockingIOError
+        :param timeout: 忽略
+        :return:
+        """
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            raise RuntimeError("AsyncClientConnectionPool must be used inside a running event loop")
+        if loop is not self._loop:
+            self.bind(loop)
+        if self._selector_dirty:
+            self._rebuild_selector()
+        conn = self._pick()
+        if conn is None and self.breakers is not None and self.breakers.check():
+            self._rebuild_selector()
+            conn = self._pick()
+        if self.metrics is not None:
+            self.metrics.observe_checkout(0.0)
+        if conn is None:
+            raise BlockingIOError("All connection are busy")
+        if conn._loop is not loop:
+            # 绑定之后在事件循环外新建的连接(如在事件循环外调用update)
+            conn.bind(loop)
+        return conn
+
+    def scatter(self, method, requests_by_host, timeout=None, **kwargs):
+        """
+        FanOut按线程的future等待结果，不能用于grpc.aio，可以用asyncio.gather同时调用各个连接
+        """
+        raise TypeError("scatter/broadcast are not supported by %s" % self.__class__.__name__)
+
+    def build_call(self, name, send):
+        """
+        异步调用返回的是调用对象，缓存等同步的调用链不适用(构造时已拒绝这些配置)，直接发送
+        """
+        return send
+
+    def bind(self, loop):
+        """
+        把所有连接绑定到loop，之后新建的连接在创建时绑定
+        :param loop: 当前运行的事件循环
+        :return:
+        """
+        for channel in list(self.pool):
+            channel.bind(loop)
+        self._loop = loop
+
+    def drain(self, channels, timeout):
+        """
+        grpc.aio channel只能在所属的事件循环中关闭，所以在事件循环中等待请求结束后关闭连接
+        在事件循环外调用时交给连接池绑定的事件循环，没有可用的事件循环时只把连接标记为DEPRECATED
+        :param channels: 已经移出连接池的连接
+        :param timeout: 最长等待时间(秒)
+        :return:
+        """
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            loop = None
+        if loop is not None:
+            task = loop.create_task(self._async_drain(channels, timeout))
+            self._drainers.add(task)
+            task.add_done_callback(self._drainers.discard)
+        elif self._loop is not None and self._loop.is_running():
+            asyncio.run_coroutine_threadsafe(self._async_drain(channels, timeout), self._loop)
+        else:
+            for c in channels:
+                c.close()
+
+    @staticmethod
+    async def _async_drain(channels, timeout):
+        deadline = monotonic() + timeout
+        while any(c.inflight for c in channels) and monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        tasks = [t for t in (c.close() for c in channels) if t is not None]
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    def start_all(self, drain_timeout=30):
+        self._loop = None
+        super(AsyncClientConnectionPool, self).start_all(drain_timeout)
+
+    async def warm_up(self, timeout=5):
+        """
+        同时建立所有连接，最多等待timeout秒
+        :param timeout:
+        :return: {"host:port": {"ready": 已连接数, "total": 连接数}}
+        """
+        return await async_wait_ready(list(self.pool), timeout)
+
+    async def aclose_all(self):
+        """
+        关闭连接池中的所有连接并等待关闭完成
+        :return:
+        """
+        tasks = [t for t in (c.close() for c in self.pool) if t is not None]
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def async_wait_ready(channels, timeout):
+    """
+    同时等待多个连接建立，所有连接共用一个截止时间
+    :param channels: [AsyncExtendChannel, ]
+    :param timeout: 最长等待时间(秒)
+    :return: {"host:port": {"ready": 已连接数, "total": 连接数}}
+    """
+    loop = asyncio.get_running_loop()
+    for c in channels:
+        c.bind(loop)
+    tasks = [asyncio.ensure_future(c.grpc_channel.channel_ready()) for c in channels]
+    if tasks:
+        await asyncio.wait(tasks, timeout=timeout)
+    report = {}
+    for c, task in zip(channels, tasks):
+        item = report.setdefault("%s:%s" % (c.host, c.port), {"ready": 0, "total": 0})
+        item["total"] += 1
+        if task.done() and not task.cancelled() and task.exception() is None:
+            item["ready"] += 1
+        else:
+            task.cancel()
+    return report
+
+
+class AsyncManager(Manager):
+    """
+    异步连接池管理器，读取与Manager相同的config.yaml
+
+        manager = AsyncManager(config="config.yaml")
+        r = await manager.GetAllCompany(Empty())
+    """
+    _instance = None
+
+    methods = {}
+    routes = {}
+    ambiguous_methods = set()
+    pools = set()
+
+    pool_cls = AsyncClientConnectionPool
+    # 事件循环中不能在__init__里等待，需要 await manager.warm_up()
+    warm_up_on_init = False
+
+    async def warm_up(self, timeout=5):
+        """
+        同时建立所有连接池的所有连接，共用一个截止时间
+        :param timeout: 最长等待时间(秒)
+        :return: {"host:port": {"ready": 已连接数, "total": 连接数}}
+        """
+        channels = []
+        for pool in list(self.pools):
+            channels.extend(pool.pool)
+        return await async_wait_ready(channels, timeout)
+
+    async def aclose(self):
+        """
+        关闭所有连接池
+        :return:
+        """
+        await asyncio.gather(*(pool.aclose_all() for pool in self.pools))
@@ -0,0 +1,249 @@
+from random import random, sample
+from time import monotonic
+
+from .utils import AliasTable, weight_random
+
+# 可以被选中的连接状态，BUSY(被ExtendChannel.use()独占)的连接留在负载均衡状态中，但选取时跳过
+SELECTABLE_STATE = ("READY", "IDLE")
+# alias表连续选中BUSY连接的次数上限，超过后在空闲连接中按权重选取
+MAX_TRIES = 8
+
+
+class Balancer(object):
+    """
+    负载均衡策略基类
+
+    rebuild在可选连接集合发生变化时调用(持有连接池的锁)，pick在每次取连接时调用(不加锁)，
+    所以rebuild需要一次性替换内部状态，不能原地修改
+    连接在BUSY和READY/IDLE之间切换时只调用set_busy更新空闲连接数O(1)，pick跳过BUSY的连接
+    """
+    name = None
+
+    def __init__(self, pool=None):
+        self.pool = pool
+        self.channels = ()
+        self._members = frozenset()
+        self._busy = set()
+        # 负载均衡状态中没有被独占的连接数，为0时pick直接返回None
+        self.free = 0
+
+    def rebuild(self, channels):
+        """
+        可选连接集合发生变化
+        :param channels: 当前READY/IDLE/BUSY的连接
+        :return:
+        """
+        self._set_channels(tuple(c for c in channels if c.weight and c.weight > 0))
+
+    def _set_channels(self, channels):
+        self.channels = channels
+        self._members = frozenset(channels)
+        self._busy = set(c for c in channels if c.state not in SELECTABLE_STATE)
+        self.free = len(channels) - len(self._busy)
+
+    def set_busy(self, channel, busy):
+        """
+        连接在BUSY和READY/IDLE之间切换，由连接池在持有锁时调用
+        :param channel:
+        :param busy: 是否变为BUSY
+        :return:
+        """
+        if channel not in self._members:
+            return
+        # 用集合记录，重建和状态通知乱序到达时重复的通知不会把计数改错
+        if busy:
+            self._busy.add(channel)
+        else:
+            self._busy.discard(channel)
+        self.free = len(self._members) - len(self._busy)
+
+    def pick(self):
+        """
+        选取一个连接，没有可用连接时返回None
+        :return:
+        """
+        raise NotImplementedError
+
+    def __len__(self):
+        return len(self.channels)
+
+
+class WeightedRandomBalancer(Balancer):
+    """
+    按权重随机，alias表选取O(1)
+    """
+    name = "weighted_random"
+
+    def __init__(self, pool=None):
+        super(WeightedRandomBalancer, self).__init__(pool)
+        self._table = AliasTable()
+
+    def rebuild(self, channels):
+        table = AliasTable(channels, key="weight")
+        self._table = table
+        self._set_channels(tuple(table.items))
+
+    def pick(self):
+        if self.free <= 0:
+            return None
+        table = self._table
+        for _ in range(MAX_TRIES):
+            channel = table.pick()
+            if channel is None or channel.state in SELECTABLE_STATE:
+                return channel
+        # 大部分连接正在被独占使用
+        return weight_random(c for c in table.items if c.state in SELECTABLE_STATE)
+
+
+def _load(channel):
+    return channel.inflight / channel.weight
+
+
+class LeastRequestBalancer(Balancer):
+    """
+    选取正在处理的请求数/权重最小的连接，相同时随机
+    """
+    name = "least_request"
+
+    def pick(self):
+        channels = self.channels
+        best = None
+        best_load = None
+        ties = 0
+        for c in channels:
+            if c.state not in SELECTABLE_STATE:
+                continue
+            load = _load(c)
+            if best is None or load < best_load:
+                best, best_load, ties = c, load, 1
+            elif load == best_load:
+                ties += 1
+                if random() * ties < 1:
+                    best = c
+        return best
+
+
+class PowerOfTwoBalancer(Balancer):
+    """
+    随机选两个连接，取正在处理的请求数/权重较小的一个
+    """
+    name = "p2c"
+
+    def pick(self):
+        if self.free <= 0:
+            return None
+        channels = self.channels
+        if len(channels) >= 2:
+            a, b = sample(channels, 2)
+            free_a = a.state in SELECTABLE_STATE
+            free_b = b.state in SELECTABLE_STATE
+            if free_a and free_b:
+                return a if _load(a) <= _load(b) else b
+            if free_a or free_b:
+                return a if free_a else b
+        free = [c for c in channels if c.state in SELECTABLE_STATE]
+        return min(free, key=_load) if free else None
+
+
+class LatencyBalancer(WeightedRandomBalancer):
+    """
+    按 权重 / (延迟移动平均 * (1 + error_penalty * 错误率移动平均)) 加权随机
+
+    有效权重每refresh_interval秒重新计算一次，没有延迟样本的连接按已有样本的平均延迟计算
+    """
+    name = "latency"
+
+    refresh_interval = 0.5
+    error_penalty = 10
+    # 延迟下限(秒)，避免极小的延迟导致权重失衡
+    min_latency = 0.001
+
+    def __init__(self, pool=None):
+        super(LatencyBalancer, self).__init__(pool)
+        self._next_refresh = 0
+        self._candidates = ()
+        self.effective_weights = {}
+
+    def rebuild(self, channels):
+        self._candidates = tuple(c for c in channels if c.weight and c.weight > 0)
+        self._refresh()
+        self._set_channels(self._candidates)
+
+    def _refresh(self):
+        self._next_refresh = monotonic() + self.refresh_interval
+        channels = self._candidates
+        known = [c.latency_ewma for c in channels if c.latency_ewma is not None]
+        default = sum(known) / len(known) if known else self.min_latency
+        weights = []
+        for c in channels:
+            latency = c.latency_ewma if c.latency_ewma is not None else default
+            error = c.error_ewma or 0.0
+            weights.append(c.weight / (max(latency, self.min_latency) * (1 + self.error_penalty * error)))
+        table = AliasTable(_Weighted(c, w) for c, w in zip(channels, weights))
+        self._table = table
+        self.effective_weights = dict((id(item.channel), item.weight) for item in table.items)
+
+    def effective_weight(self, channel):
+        """
+        连接当前的有效权重
+        :param channel:
+        :return:
+        """
+        return self.effective_weights.get(id(channel), 0)
+
+    def pick(self):
+        if monotonic() >= self._next_refresh:
+            lock = self.pool._lock if self.pool else None
+            if lock is None:
+                self._refresh()
+            elif lock.acquire(False):
+                try:
+                    self._refresh()
+                finally:
+                    lock.release()
+        if self.free <= 0:
+            return None
+        table = self._table
+        for _ in range(MAX_TRIES):
+            item = table.pick()
+            if item is None:
+                return None
+            if item.channel.state in SELECTABLE_STATE:
+                return item.channel
+        item = weight_random(i for i in table.items if i.channel.state in SELECTABLE_STATE)
+        return item.channel if item is not None else None
+
+
+class _Weighted(object):
+    __slots__ = ("channel", "weight")
+
+    def __init__(self, channel, weight):
+        self.channel = channel
+        self.weight = weight
+
+
+BALANCERS = {
+    WeightedRandomBalancer.name: WeightedRandomBalancer,
+    LeastRequestBalancer.name: LeastRequestBalancer,
+    PowerOfTwoBalancer.name: PowerOfTwoBalancer,
+    LatencyBalancer.name: LatencyBalancer,
+}
+
+
+def get_balancer(balancer, pool=None):
+    """
+    通过名称或类创建负载均衡策略
+    :param balancer: 策略名称、Balancer子类或实例
+    :param pool: 连接池
+    :return:
+    """
+    if balancer is None:
+        balancer = WeightedRandomBalancer.name
+    if isinstance(balancer, Balancer):
+        balancer.pool = pool
+        return balancer
+    if isinstance(balancer, str):
+        if balancer not in BALANCERS:
+            raise ValueError("unknown balancer [%s], must in %s" % (balancer, list(BALANCERS)))
+        balancer = BALANCERS[balancer]
+    return balancer(pool)
@@ -0,0 +1,207 @@
+from threading import Event, Lock, Thread
+from time import monotonic
+
+from .config import import_string
+from .errors import DeadlineExceeded, NotFound
+
+# 按key字段的类型选择打包进Any的包装类型，第一次合并请求时才导入，不增加导入client的时间
+WRAPPERS = {}
+
+
+def wrapper_for(field_type):
+    """
+    key字段类型对应的wrappers_pb2包装类型
+    :param field_type: FieldDescriptor.TYPE_*
+    :return:
+    """
+    if not WRAPPERS:
+        from google.protobuf.descriptor import FieldDescriptor
+        from google.protobuf import wrappers_pb2
+        WRAPPERS.update({
+            FieldDescriptor.TYPE_INT32: wrappers_pb2.Int32Value,
+            FieldDescriptor.TYPE_SINT32: wrappers_pb2.Int32Value,
+            FieldDescriptor.TYPE_INT64: wrappers_pb2.Int64Value,
+            FieldDescriptor.TYPE_SINT64: wrappers_pb2.Int64Value,
+            FieldDescriptor.TYPE_UINT32: wrappers_pb2.UInt32Value,
+            FieldDescriptor.TYPE_UINT64: wrappers_pb2.UInt64Value,
+            FieldDescriptor.TYPE_STRING: wrappers_pb2.StringValue,
+            FieldDescriptor.TYPE_BYTES: wrappers_pb2.BytesValue,
+            FieldDescriptor.TYPE_BOOL: wrappers_pb2.BoolValue,
+        })
+    return WRAPPERS[field_type]
+
+
+class _Slot(object):
+    __slots__ = ("key", "event", "response", "error")
+
+    def __init__(self, key):
+        self.key = key
+        self.event = Event()
+        self.response = None
+        self.error = None
+
+
+class _Batch(object):
+    __slots__ = ("slots", "full", "timeout")
+
+    def __init__(self):
+        self.slots = []
+        self.full = Event()
+        self.timeout = 0
+
+
+class MicroBatcher(object):
+    """
+    把短时间内的单条查询(如RetrieveCompany)合并成一次列表查询(如ListCompany)，再按key把结果分给每个调用者
+
+    一批中的第一个调用者负责等待window秒(或凑满max_batch条)后发送列表请求，其他调用者等待结果
+    列表请求的超时取一批中最长的，第一个调用者的超时较短时在后台线程中发送，它和其他调用者一样只等待自己的超时
+    """
+
+    def __init__(self, list_call, key="id", filter="filter", items="company", window=0.002, max_batch=100,
+                 list_request=None, wrapper=None):
+        """
+        :param list_call: 列表方法的调用 call(args, kwargs)
+        :param key: 单条请求和列表响应条目中用来对应的字段
+        :param filter: 列表请求中放key集合的字段(repeated google.protobuf.Any)
+        :param items: 列表响应中的条目字段
+        :param window: 收集请求的最长时间(秒)
+        :param max_batch: 一批最多的请求数，凑满时立即发送
+        :param list_request: 列表请求的类型，默认与单条请求相同
+        :param wrapper: 打包key的类型，默认按key字段的类型选择wrappers_pb2中的包装类型
+        """
+        self.list_call = list_call
+        self.key = key
+        self.filter = filter
+        self.items = items
+        self.window = window
+        self.max_batch = max_batch
+        self.list_request = list_request
+        self.wrapper = wrapper
+        self._batch = None
+        self._lock = Lock()
+        self.batches = 0
+        self.requests = 0
+
+    def batchable(self, request):
+        """
+        只有key以外没有设置其他字段的请求才能合并，否则列表查询的语义不同
+        :param request:
+        :return:
+        """
+        fields = request.ListFields()
+        return len(fields) == 1 and fields[0][0].name == self.key
+
+    def _build_request(self, sample, keys):
+        request_cls = self.list_request or type(sample)
+        wrapper = self.wrapper or wrapper_for(sample.DESCRIPTOR.fields_by_name[self.key].type)
+        request = request_cls()
+        repeated = getattr(request, self.filter)
+        for key in keys:
+            repeated.add().Pack(wrapper(value=key))
+        return request
+
+    def _flush(self, batch, sample, timeout):
+        try:
+            if timeout is not None and timeout <= 0:
+                # 收集请求期间已经超时，不发送没有超时限制的列表请求
+                raise DeadlineExceeded("Deadline Exceeded before the batched call was sent")
+            keys = list(dict.fromkeys(slot.key for slot in batch.slots))
+            request = self._build_request(sample, keys)
+            response = self.list_call((request,), {} if timeout is None else {"timeout": timeout})
+            found = dict((getattr(item, self.key), item) for item in getattr(response, self.items))
+        except BaseException as e:
+            for slot in batch.slots:
+                slot.error = e
+                slot.event.set()
+            return
+        for slot in batch.slots:
+            item = found.get(slot.key)
+            if item is None:
+                slot.error = NotFound("[%s=%s] not found in batched response" % (self.key, slot.key))
+            else:
+                slot.response = type(item)()
+                slot.response.CopyFrom(item)
+            slot.event.set()
+
+    def submit(self, request, timeout=None):
+        """
+        把一条单条查询加入当前批次并等待结果
+        :param request: 单条请求
+        :param timeout: 超时时间(秒)
+        :return: 响应条目
+        """
+        slot = _Slot(getattr(request, self.key))
+        with self._lock:
+            self.requests += 1
+            batch = self._batch
+            leader = batch is None
+            if leader:
+                batch = self._batch = _Batch()
+                self.batches += 1
+            batch.slots.append(slot)
+            # 批次的超时取所有调用者中最长的，不限制超时的调用者使列表请求也不限制
+            if batch.timeout is not None:
+                batch.timeout = None if timeout is None else max(batch.timeout, timeout)
+            if len(batch.slots) >= self.max_batch:
+                self._batch = None
+                batch.full.set()
+
+        if leader:
+            start = monotonic()
+            batch.full.wait(self.window if timeout is None else min(self.window, timeout))
+            with self._lock:
+                if self._batch is batch:
+                    self._batch = None
+            if timeout is None or batch.timeout == timeout:
+                # 自己的超时就是批次的超时，直接发送
+                self._flush(batch, request, None if timeout is None else timeout - (monotonic() - start))
+            else:
+                flusher = Thread(target=self._flush, args=(batch, request, batch.timeout), name="grpc-batch-flush",
+                                 daemon=True)
+                flusher.start()
+                timeout = max(timeout - (monotonic() - start), 0)
+        if not slot.event.wait(timeout):
+            raise DeadlineExceeded("Deadline Exceeded while waiting for a batched call")
+        if slot.error is not None:
+            raise slot.error
+        return slot.response
+
+    def stats(self):
+        """
+        合并前的请求数和实际发出的列表请求数
+        :return:
+        """
+        return {"requests": self.requests, "batches": self.batches}
+
+    def wrap(self, call):
+        """
+        在调用链上加一层批量合并，带metadata或设置了key以外字段的请求直接发送
+        :param call: call(args, kwargs)
+        :return:
+        """
+
+        def batched(args, kwargs):
+            if kwargs.get("metadata") or len(args) != 1 or not self.batchable(args[0]):
+                return call(args, kwargs)
+            return self.submit(args[0], kwargs.get("timeout"))
+
+        return batched
+
+
+def build_batchers(config, list_call):
+    """
+    根据配置创建每个方法的批量合并
+    :param config: {单条方法名: {"list_method": 列表方法名, "key":, "filter":, "items":, "window":, "max_batch":}}
+    :param list_call: list_call(列表方法名) 返回列表方法的调用
+    :return: {方法名: MicroBatcher}
+    """
+    batchers = {}
+    for name, options in (config or {}).items():
+        options = dict(options)
+        list_method = options.pop("list_method")
+        for option in ("list_request", "wrapper"):
+            if isinstance(options.get(option), str):
+                options[option] = import_string(options[option])
+        batchers[name] = MicroBatcher(list_call(list_method), **options)
+    return batchers
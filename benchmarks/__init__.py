@@ -0,0 +1,5 @@
+"""
+连接池性能基准测试，不依赖真实的grpc服务端
+
+    python -m grpc_client_pool.benchmarks.contention
+"""
@@ -0,0 +1,77 @@
+"""
+不建立网络连接的channel，基准测试中用来替换真实的grpc channel
+"""
+from ..callback_handler import DefaultCallBackHandler
+from ..client import ClientConnectionPool, ExtendChannel
+from ..manager import Manager
+
+
+class OfflineGrpcChannel(object):
+    """
+    只实现ExtendChannel用到的接口
+    """
+
+    def __init__(self, target):
+        self.target = target
+        self.callbacks = []
+
+    def subscribe(self, callback, try_to_connect=False):
+        self.callbacks.append(callback)
+
+    def unsubscribe(self, callback):
+        if callback in self.callbacks:
+            self.callbacks.remove(callback)
+
+    def unary_unary(self, method, request_serializer=None, response_deserializer=None):
+        return lambda request, timeout=None, metadata=None: None
+
+    def close(self):
+        pass
+
+
+class QuietCallBackHandler(DefaultCallBackHandler):
+    """
+    不打印日志的回调handler
+    """
+
+    def log(self, channel, message):
+        pass
+
+
+class BenchManager(Manager):
+    """
+    独立的Manager，不影响进程中其他Manager的方法表
+    """
+    methods = {}
+    routes = {}
+    ambiguous_methods = set()
+    pools = set()
+    warm_up_on_init = False
+
+
+class OfflineChannel(ExtendChannel):
+    def connect(self):
+        return OfflineGrpcChannel("{}:{}".format(self.host, self.port))
+
+
+class OfflinePool(ClientConnectionPool):
+    """
+    使用OfflineChannel的连接池
+    """
+    channel_cls = OfflineChannel
+    callback_handler = QuietCallBackHandler
+
+
+def offline_pool(pool_size=5, hosts=2, weights=None, stub_cls=None, pool_cls=OfflinePool, **kwargs):
+    """
+    创建一个不连网的连接池
+    :param pool_size: 连接数
+    :param hosts: 主机数，端口从9100开始递增
+    :param weights: 各主机的权重
+    :param stub_cls: 存根类
+    :param pool_cls: 连接池类
+    :return:
+    """
+    host = ["127.0.0.1"] * hosts
+    port = [9100 + i for i in range(hosts)]
+    return pool_cls(host=host, port=port, pool_size=pool_size, weights=weights, stub_cls=stub_cls, **kwargs)
@@ -0,0 +1,96 @@
+"""
+进程内的CompanyServer，监听随机端口，可配置延迟和返回的数据量
+"""
+import os
+import sys
+import time
+from concurrent import futures
+
+import grpc
+from google.protobuf.wrappers_pb2 import Int32Value
+
+try:
+    from protogen import company_pb2, company_pb2_grpc
+except ImportError:
+    # protogen中的生成代码使用绝对导入，需要仓库根目录在sys.path中
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from protogen import company_pb2, company_pb2_grpc
+
+
+def company_list(companies=0):
+    """
+    构造包含companies个Company的CompanyList
+    :param companies:
+    :return:
+    """
+    return company_pb2.CompanyList(company=[
+        company_pb2.Company(id=i, name="company-%d" % i, address="address-%d" % i, phone="1380000%04d" % i)
+        for i in range(companies)
+    ])
+
+
+class FakeCompanyServicer(company_pb2_grpc.CompanyServerServicer):
+    """
+    按配置的延迟返回固定的数据
+    """
+
+    def __init__(self, latency=0, companies=0):
+        self.latency = latency
+        self.response = company_list(companies)
+        self.calls = 0
+
+    def _reply(self):
+        self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+        return self.response
+
+    def GetAllCompany(self, request, context):
+        return self._reply()
+
+    def ListCompany(self, request, context):
+        if not request.filter:
+            return self._reply()
+        # filter中是打包成Int32Value的id集合(见batch.MicroBatcher)
+        self._reply()
+        ids = []
+        for item in request.filter:
+            value = Int32Value()
+            item.Unpack(value)
+            ids.append(value.value)
+        return company_pb2.CompanyList(company=[company_pb2.Company(id=i, name="company-%d" % i) for i in ids])
+
+    def RetrieveCompany(self, request, context):
+        self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+        return company_pb2.Company(id=request.id, name="company-%d" % request.id)
+
+
+def start_server(latency=0, companies=0, workers=16, servicer=None):
+    """
+    在随机端口上启动服务
+    :param latency: 每个请求的处理时间(秒)
+    :param companies: GetAllCompany/ListCompany返回的Company数量
+    :param workers: 服务端线程数
+    :param servicer: 自定义的servicer
+    :return: (server, port, servicer)
+    """
+    servicer = servicer or FakeCompanyServicer(latency, companies)
+    server = grpc.server(futures.ThreadPoolExecutor(max_workers=workers))
+    company_pb2_grpc.add_CompanyServerServicer_to_server(servicer, server)
+    port = server.add_insecure_port("127.0.0.1:0")
+    server.start()
+    return server, port, servicer
+
+
+def start_servers(n, latency=0, companies=0, workers=16):
+    """
+    启动n个相同配置的服务，模拟多个后端
+    :param n: 服务数量
+    :param latency:
+    :param companies:
+    :param workers:
+    :return: [(server, port, servicer), ]
+    """
+    return [start_server(latency, companies, workers) for _ in range(n)]
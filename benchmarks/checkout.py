@@ -0,0 +1,258 @@
+"""
+取连接的微基准，不连网
+
+    get_one_connection: 只取连接
+    use:                取连接后 with channel.use()，连接在使用期间变为BUSY
+    weight_random:      utils.weight_random 在整个连接池上按权重选取
+
+每组测试先不加测量跑一遍得到ns/op，再把连接池和连接的锁换成计时的锁跑一遍，得到等锁时间占线程总时间的比例
+最后用卡方检验检查负载均衡策略和weight_random选出的各地址比例是否与配置的地址权重一致
+
+    python -m grpc_client_pool.benchmarks.checkout --threads 1,4,16,64 --pool-sizes 3,100,1000,10000
+"""
+import argparse
+import json
+import math
+import threading
+import time
+
+from ..utils import weight_random
+from ._offline import offline_pool
+
+TARGETS = ("get_one_connection", "use", "weight_random")
+
+
+class TimedLock(object):
+    """
+    记录等待时间的锁，等待时间在拿到锁之后累加，不需要额外的锁
+    """
+    __slots__ = ("_lock", "wait")
+
+    def __init__(self, lock):
+        self._lock = lock
+        self.wait = 0.0
+
+    def acquire(self, blocking=True, timeout=-1):
+        start = time.perf_counter()
+        ok = self._lock.acquire(blocking, timeout)
+        if ok:
+            self.wait += time.perf_counter() - start
+        return ok
+
+    def release(self):
+        self._lock.release()
+
+    def locked(self):
+        return self._lock.locked()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+
+def make_pool(pool_size, hosts=3, broken=0.0, balancer=None):
+    """
+    创建一个不连网的连接池，每个地址都有broken比例的连接处于CONNECTING/TRANSIENT_FAILURE
+    :param pool_size: 连接数
+    :param hosts: 主机数，权重依次为1, 2, ...
+    :param broken: 不可用连接的比例
+    :param balancer: 负载均衡策略
+    :return:
+    """
+    pool = offline_pool(pool_size=pool_size, hosts=hosts, weights=list(range(1, hosts + 1)), balancer=balancer)
+    by_address = {}
+    for channel in sorted(pool.pool, key=lambda c: c.connect_id):
+        by_address.setdefault((channel.host, channel.port), []).append(channel)
+    for channels in by_address.values():
+        n = int(len(channels) * broken)
+        for i, channel in enumerate(channels[:n]):
+            # 直接设置状态，不经过回调handler，避免触发重连
+            channel._set_state("CONNECTING" if i % 2 else "TRANSIENT_FAILURE")
+        for channel in channels[n:]:
+            channel._set_state("READY")
+    # 预先重建选取状态，只测稳定状态下的开销
+    pool.get_one_connection()
+    return pool
+
+
+def _operation(target, pool):
+    if target == "get_one_connection":
+        return pool.get_one_connection
+    if target == "weight_random":
+        channels = list(pool.pool)
+        return lambda: weight_random(channels)
+
+    def use():
+        channel = pool.get_one_connection()
+        with channel.use():
+            pass
+
+    return use
+
+
+def _instrument(pool):
+    locks = [TimedLock(pool._lock)]
+    pool._lock = locks[0]
+    for channel in pool.pool:
+        channel._lock = TimedLock(channel._lock)
+        locks.append(channel._lock)
+    return locks
+
+
+def _run_threads(op, threads, ops):
+    barrier = threading.Barrier(threads + 1)
+    misses = [0] * threads
+
+    def worker(i):
+        barrier.wait()
+        for _ in range(ops):
+            try:
+                op()
+            except BlockingIOError:
+                misses[i] += 1
+
+    workers = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+    for t in workers:
+        t.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for t in workers:
+        t.join()
+    return time.perf_counter() - start, sum(misses)
+
+
+def run(target, threads, pool_size, ops, broken=0.0, balancer=None):
+    """
+    运行一组测试
+    :param target: get_one_connection / use / weight_random
+    :param threads: 线程数
+    :param pool_size: 连接数
+    :param ops: 每个线程的操作次数，use和weight_random每次操作是O(连接数)，按连接数等比减少
+    :param broken: 不可用连接的比例
+    :param balancer: 负载均衡策略
+    :return: 结果字典
+    """
+    if target != "get_one_connection":
+        ops = max(20, ops * 10 // max(pool_size, 10))
+    pool = make_pool(pool_size, broken=broken, balancer=balancer)
+    elapsed, misses = _run_threads(_operation(target, pool), threads, ops)
+
+    timed = make_pool(pool_size, broken=broken, balancer=balancer)
+    locks = _instrument(timed)
+    timed_elapsed, _ = _run_threads(_operation(target, timed), threads, ops)
+    wait = sum(lock.wait for lock in locks)
+    pool.close_all()
+    timed.close_all()
+
+    total = threads * ops
+    return {
+        "target": target,
+        "threads": threads,
+        "pool_size": pool_size,
+        "broken": broken,
+        "ops": total,
+        "misses": misses,
+        "seconds": elapsed,
+        "ns_per_op": elapsed * 1e9 / total,
+        "lock_wait_fraction": wait / (timed_elapsed * threads) if timed_elapsed else 0.0,
+    }
+
+
+def chi_square_p(statistic, dof):
+    """
+    卡方分布的上尾概率，用Wilson-Hilferty近似
+    :param statistic:
+    :param dof: 自由度
+    :return:
+    """
+    if dof <= 0:
+        return 1.0
+    z = ((statistic / dof) ** (1.0 / 3) - (1 - 2.0 / (9 * dof))) / math.sqrt(2.0 / (9 * dof))
+    return 0.5 * math.erfc(z / math.sqrt(2))
+
+
+def accuracy(pick, pool, samples):
+    """
+    取samples次，按地址统计，与按配置的地址权重的期望次数做卡方检验
+    :param pick: 无参数，返回一个连接
+    :param pool: 连接池，提供地址和权重
+    :param samples: 取样次数
+    :return: {"chi_square":, "dof":, "p_value":, "max_share_error":}
+    """
+    weights = dict(zip(zip(pool.hosts, pool.ports), pool.weights))
+    counts = dict((address, 0) for address in weights)
+    for _ in range(samples):
+        c = pick()
+        counts[(c.host, c.port)] += 1
+    total_weight = float(sum(weights.values()))
+    statistic = 0.0
+    max_error = 0.0
+    for address, weight in weights.items():
+        expected = samples * weight / total_weight
+        observed = counts[address]
+        statistic += (observed - expected) ** 2 / expected
+        max_error = max(max_error, abs(observed - expected) / samples)
+    dof = len(weights) - 1
+    return {"chi_square": statistic, "dof": dof, "p_value": chi_square_p(statistic, dof),
+            "max_share_error": max_error}
+
+
+def check_distribution(pool_size=12, samples=200000, broken=0.25, alpha=0.001):
+    """
+    检查按权重选取的负载均衡策略(weighted_random)和weight_random在有不可用连接时各地址的比例
+    :param pool_size: 连接数
+    :param samples: 取样次数
+    :param broken: 不可用连接的比例
+    :param alpha: p值低于它时认为分布有偏差
+    :return: {名称: 检验结果}
+    """
+    results = {}
+    pool = make_pool(pool_size, broken=broken, balancer="weighted_random")
+    results["weighted_random"] = accuracy(pool.get_one_connection, pool, samples)
+    pool.close_all()
+    pool = make_pool(pool_size, broken=broken)
+    usable = [c for c in pool.pool if c.state in pool.selectable_state]
+    results["weight_random"] = accuracy(lambda: weight_random(usable), pool, samples)
+    pool.close_all()
+    for result in results.values():
+        result["ok"] = result["p_value"] >= alpha
+    return results
+
+
+def _ints(value):
+    return [int(x) for x in value.split(",") if x]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--targets", default=",".join(TARGETS))
+    parser.add_argument("--threads", type=_ints, default=[1, 4, 16, 64])
+    parser.add_argument("--pool-sizes", type=_ints, default=[3, 100, 1000, 10000])
+    parser.add_argument("--ops", type=int, default=5000, help="operations per thread")
+    parser.add_argument("--broken", type=float, default=0.2, help="fraction of channels not READY")
+    parser.add_argument("--balancer", default=None)
+    parser.add_argument("--samples", type=int, default=200000, help="picks for the distribution check")
+    parser.add_argument("--out", help="write JSON here instead of stdout")
+    args = parser.parse_args(argv)
+
+    results = []
+    for pool_size in args.pool_sizes:
+        for target in args.targets.split(","):
+            for threads in args.threads:
+                results.append(run(target, threads, pool_size, args.ops, args.broken, args.balancer))
+    report = {"results": results, "distribution": check_distribution(samples=args.samples, broken=args.broken)}
+    text = json.dumps(report, indent=2)
+    if args.out:
+        with open(args.out, "w") as f:
+            f.write(text)
+    else:
+        print(text)
+    if not all(r["ok"] for r in report["distribution"].values()):
+        raise SystemExit("weighted selection does not match the configured weights")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+"""
+多连接池、多线程并发取连接的竞争测试
+
+对比两种模式:
+    global: 模拟旧实现，所有连接池的取连接和连接状态回调共用一把进程级的锁
+    pool:   当前实现，每个连接池、每个连接各自加锁
+
+    python -m grpc_client_pool.benchmarks.contention --pools 4 --threads 32
+"""
+import argparse
+import json
+import threading
+import time
+
+from grpc import ChannelConnectivity
+
+from ._offline import OfflinePool, offline_pool
+
+_global_lock = threading.Lock()
+
+
+class GlobalLockPool(OfflinePool):
+    """
+    取连接时持有进程级锁的连接池
+    """
+
+    def get_one_connection(self):
+        with _global_lock:
+            return super(GlobalLockPool, self).get_one_connection()
+
+
+def _callback_storm(pools, stop, global_lock):
+    """
+    不停地触发连接状态回调，模拟抖动的后端
+    """
+    states = (ChannelConnectivity.READY, ChannelConnectivity.IDLE)
+    i = 0
+    while not stop.is_set():
+        for pool in pools:
+            for channel in list(pool.pool):
+                if global_lock:
+                    with _global_lock:
+                        channel.callback(states[i & 1])
+                else:
+                    channel.callback(states[i & 1])
+        i += 1
+        time.sleep(0.001)
+
+
+def run(mode, pools=4, threads=32, pool_size=8, iterations=20000):
+    """
+    运行一轮测试，每个线程取iterations次连接，统计总耗时
+    :param mode: global 或 pool
+    :param pools: 连接池数量
+    :param threads: 取连接的线程数
+    :param pool_size: 每个连接池的连接数
+    :param iterations: 每个线程取连接的次数
+    :return: 结果字典
+    """
+    global_lock = mode == "global"
+    pool_cls = GlobalLockPool if global_lock else OfflinePool
+    pool_list = [offline_pool(pool_size=pool_size, pool_cls=pool_cls) for _ in range(pools)]
+    stop = threading.Event()
+    barrier = threading.Barrier(threads + 1)
+
+    def worker(n):
+        pool = pool_list[n % len(pool_list)]
+        barrier.wait()
+        for _ in range(iterations):
+            try:
+                pool.get_one_connection()
+            except BlockingIOError:
+                pass
+
+    workers = [threading.Thread(target=worker, args=(n,)) for n in range(threads)]
+    storm = threading.Thread(target=_callback_storm, args=(pool_list, stop, global_lock))
+    for t in workers:
+        t.start()
+    storm.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for t in workers:
+        t.join()
+    elapsed = time.perf_counter() - start
+    stop.set()
+    storm.join()
+
+    ops = threads * iterations
+    return {
+        "mode": mode,
+        "pools": pools,
+        "threads": threads,
+        "pool_size": pool_size,
+        "ops": ops,
+        "seconds": elapsed,
+        "ops_per_sec": ops / elapsed,
+        "ns_per_op": elapsed * 1e9 / ops,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pools", type=int, default=4)
+    parser.add_argument("--threads", type=int, default=32)
+    parser.add_argument("--pool-size", type=int, default=8)
+    parser.add_argument("--iterations", type=int, default=20000)
+    args = parser.parse_args(argv)
+
+    results = [run(mode, args.pools, args.threads, args.pool_size, args.iterations) for mode in ("global", "pool")]
+    speedup = results[1]["ops_per_sec"] / results[0]["ops_per_sec"] if results[0]["ops_per_sec"] else None
+    print(json.dumps({"results": results, "speedup": speedup}, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+"""
+冷启动导入耗时，基于 python -X importtime
+
+    python -m grpc_client_pool.benchmarks.importtime
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+PACKAGE = __package__.rsplit(".", 1)[0]
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+STATEMENTS = (
+    "import {pkg}",
+    "from {pkg} import Manager",
+    "from {pkg}.aio import AsyncManager",
+)
+
+
+def importtime(statement, repeat=5):
+    """
+    在新的解释器中执行导入语句，返回最快一次的耗时
+    :param statement: 导入语句
+    :param repeat: 重复次数
+    :return: {"total_us": 总耗时, "modules": 本次导入的模块数, "top": [(模块, 累计耗时us)]}
+    """
+    best = None
+    for _ in range(repeat):
+        proc = subprocess.run([sys.executable, "-X", "importtime", "-c", statement], cwd=ROOT,
+                              stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+        if proc.returncode:
+            raise RuntimeError(proc.stderr)
+        rows = []
+        for line in proc.stderr.splitlines():
+            if not line.startswith("import time:") or "cumulative" in line:
+                continue
+            self_us, cumulative, name = line.split(":", 1)[1].split("|")
+            rows.append((name.strip(), int(self_us), int(cumulative), len(name) - len(name.lstrip())))
+        # 解释器启动时导入的site及之前的模块不计入，之后的顶层模块累计耗时之和即为导入语句的耗时
+        names = [r[0] for r in rows]
+        if "site" in names:
+            rows = rows[len(names) - names[::-1].index("site"):]
+        top_level = min(r[3] for r in rows)
+        total = sum(r[2] for r in rows if r[3] == top_level)
+        result = {
+            "total_us": total,
+            "modules": len(rows),
+            "top": sorted(((r[0], r[2]) for r in rows), key=lambda r: -r[1])[:10],
+        }
+        if best is None or result["total_us"] < best["total_us"]:
+            best = result
+    return best
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args(argv)
+
+    results = {}
+    for statement in STATEMENTS:
+        statement = statement.format(pkg=PACKAGE)
+        results[statement] = importtime(statement, args.repeat)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,173 @@
+"""
+连接进程内的CompanyServer，对比直接用stub、ClientConnectionPool和Manager路由的吞吐量和延迟分位数
+
+    raw:     每个后端一个grpc channel，线程轮流使用
+    pool:    一个连接多个后端的ClientConnectionPool
+    manager: 同样的连接池注册到Manager，通过Manager.GetAllCompany调用
+
+    python -m grpc_client_pool.benchmarks.throughput --threads 1,4,16 --pool-sizes 2,8 --hosts 1,2 --companies 100
+"""
+import argparse
+import json
+import platform
+import threading
+import time
+
+import grpc
+
+from ..client import ClientConnectionPool
+from ._offline import BenchManager, QuietCallBackHandler
+from ._server import company_pb2_grpc, start_servers
+
+
+class _QuietPool(ClientConnectionPool):
+    callback_handler = QuietCallBackHandler
+
+
+def _percentile(values, p):
+    if not values:
+        return None
+    return values[min(int(len(values) * p / 100.0), len(values) - 1)]
+
+
+def _drive(targets, threads, calls):
+    """
+    threads个线程各调用calls次，第i个线程使用targets[i % len(targets)]
+    :return: (耗时, 每次调用的延迟列表, 错误数)
+    """
+    from google.protobuf.empty_pb2 import Empty
+
+    request = Empty()
+    barrier = threading.Barrier(threads + 1)
+    latencies = [None] * threads
+    errors = [0] * threads
+
+    def worker(i):
+        fn = targets[i % len(targets)]
+        samples = []
+        barrier.wait()
+        for _ in range(calls):
+            start = time.perf_counter()
+            try:
+                fn(request)
+            except (grpc.RpcError, BlockingIOError):
+                errors[i] += 1
+            samples.append(time.perf_counter() - start)
+        latencies[i] = samples
+
+    workers = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+    for t in workers:
+        t.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for t in workers:
+        t.join()
+    elapsed = time.perf_counter() - start
+    return elapsed, sorted(x for samples in latencies for x in samples), sum(errors)
+
+
+def run(mode, ports, threads, pool_size, calls, warm_up=50):
+    """
+    运行一组测试
+    :param mode: raw / pool / manager
+    :param ports: 后端端口列表
+    :param threads: 线程数
+    :param pool_size: 连接池大小，raw模式忽略
+    :param calls: 每个线程的调用次数
+    :param warm_up: 正式测试前每个调用对象的预热调用次数
+    :return: 结果字典
+    """
+    from google.protobuf.empty_pb2 import Empty
+
+    channels = []
+    pool = manager = None
+    if mode == "raw":
+        channels = [grpc.insecure_channel("127.0.0.1:%d" % port) for port in ports]
+        targets = [company_pb2_grpc.CompanyServerStub(c).GetAllCompany for c in channels]
+    else:
+        pool = _QuietPool(host=["127.0.0.1"] * len(ports), port=list(ports), pool_size=pool_size,
+                          stub_cls=company_pb2_grpc.CompanyServerStub)
+        pool.warm_up(5)
+        if mode == "manager":
+            manager = BenchManager()
+            manager.register(pool)
+            targets = [lambda request: manager.GetAllCompany(request)]
+        else:
+            targets = [pool.GetAllCompany]
+    try:
+        for fn in targets:
+            for _ in range(warm_up):
+                fn(Empty())
+        elapsed, latencies, errors = _drive(targets, threads, calls)
+    finally:
+        if manager is not None:
+            manager.unregister(pool)
+        if pool is not None:
+            pool.close_all()
+        for c in channels:
+            c.close()
+
+    total = threads * calls
+    return {
+        "mode": mode,
+        "threads": threads,
+        "pool_size": None if mode == "raw" else pool_size,
+        "hosts": len(ports),
+        "calls": total,
+        "errors": errors,
+        "seconds": elapsed,
+        "calls_per_sec": total / elapsed,
+        "p50_ms": _percentile(latencies, 50) * 1e3,
+        "p99_ms": _percentile(latencies, 99) * 1e3,
+    }
+
+
+def _ints(value):
+    return [int(x) for x in value.split(",") if x]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--modes", default="raw,pool,manager")
+    parser.add_argument("--threads", type=_ints, default=[1, 4, 16])
+    parser.add_argument("--pool-sizes", type=_ints, default=[2, 8])
+    parser.add_argument("--hosts", type=_ints, default=[1, 2])
+    parser.add_argument("--calls", type=int, default=300, help="calls per thread")
+    parser.add_argument("--latency", type=float, default=0, help="server latency (seconds)")
+    parser.add_argument("--companies", type=int, default=10, help="Company messages per CompanyList")
+    parser.add_argument("--workers", type=int, default=16, help="server threads per host")
+    parser.add_argument("--out", help="write JSON here instead of stdout")
+    args = parser.parse_args(argv)
+
+    servers = start_servers(max(args.hosts), args.latency, args.companies, args.workers)
+    results = []
+    try:
+        for hosts in args.hosts:
+            ports = [port for _, port, _ in servers[:hosts]]
+            for threads in args.threads:
+                for mode in args.modes.split(","):
+                    for pool_size in ([None] if mode == "raw" else args.pool_sizes):
+                        if pool_size is not None and pool_size < hosts:
+                            # 连接池要求每个地址至少一个连接
+                            continue
+                        results.append(run(mode, ports, threads, pool_size, args.calls))
+    finally:
+        for server, _, _ in servers:
+            server.stop(None)
+
+    report = {
+        "config": {"latency": args.latency, "companies": args.companies, "calls_per_thread": args.calls,
+                   "server_workers": args.workers},
+        "env": {"python": platform.python_version(), "grpc": grpc.__version__, "machine": platform.machine()},
+        "results": results,
+    }
+    text = json.dumps(report, indent=2)
+    if args.out:
+        with open(args.out, "w") as f:
+            f.write(text)
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main()
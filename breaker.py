@@ -0,0 +1,290 @@
+from threading import Lock
+from time import monotonic
+
+from grpc import StatusCode
+
+CLOSED = "CLOSED"
+OPEN = "OPEN"
+HALF_OPEN = "HALF_OPEN"
+
+# 默认算作地址故障的状态码名称，NOT_FOUND等业务错误不算
+FAILURE_CODES = ("UNAVAILABLE", "INTERNAL", "UNKNOWN", "DEADLINE_EXCEEDED")
+
+
+def failure_code_set(names):
+    """
+    :param names: 状态码名称，不区分大小写
+    :return: frozenset(StatusCode)
+    """
+    return frozenset(getattr(StatusCode, code.upper()) for code in names)
+
+
+class CircuitBreaker(object):
+    """
+    一个地址的熔断器，CLOSED(正常) -> OPEN(摘除) -> HALF_OPEN(放回试探) -> CLOSED/OPEN
+    """
+    __slots__ = ("address", "state", "consecutive_failures", "requests", "failures", "window_start",
+                 "ejections", "ejected_at", "ejected_until", "closed_at", "probes", "probers")
+
+    def __init__(self, address):
+        self.address = address
+        self.state = CLOSED
+        self.consecutive_failures = 0
+        self.requests = 0
+        self.failures = 0
+        self.window_start = monotonic()
+        self.ejections = 0
+        self.ejected_at = None
+        self.ejected_until = None
+        self.closed_at = None
+        # HALF_OPEN时正在进行的试探请求数，以及每个连接上占用的试探名额 {连接: 数量}
+        self.probes = 0
+        self.probers = {}
+
+    def info(self):
+        return {
+            "state": self.state, "consecutive_failures": self.consecutive_failures, "ejections": self.ejections,
+            "ejected_for": None if self.ejected_until is None else max(self.ejected_until - monotonic(), 0),
+            "window": {"requests": self.requests, "failures": self.failures},
+        }
+
+
+class CircuitBreakers(object):
+    """
+    连接池中每个地址的熔断器，按连续失败次数或时间窗口内的错误率摘除地址
+
+    被摘除的地址在摘除时间内不参与选取，摘除时间随摘除次数线性增长，同时被摘除的地址数不超过max_ejection_percent
+    摘除时间到期后进入HALF_OPEN，同时最多放行half_open_requests个试探请求，试探成功则恢复，失败则再次摘除
+    只有failure_codes中的状态码算作地址的故障，NOT_FOUND等业务错误和取消的调用不影响熔断
+    """
+
+    def __init__(self, pool, consecutive_failures=5, error_rate=0.5, window=10, min_requests=20,
+                 base_ejection=30, max_ejection=300, max_ejection_percent=50, half_open_requests=1,
+                 failure_codes=FAILURE_CODES):
+        """
+        :param pool: 连接池，熔断器状态变化时通知它重建负载均衡状态
+        :param consecutive_failures: 连续失败多少次时摘除，为None时不按连续失败摘除
+        :param error_rate: 时间窗口内错误率达到多少时摘除，为None时不按错误率摘除
+        :param window: 统计错误率的时间窗口(秒)
+        :param min_requests: 时间窗口内至少有多少请求才按错误率判断
+        :param base_ejection: 第一次摘除的时间(秒)，第n次摘除n倍的时间
+        :param max_ejection: 最长摘除时间(秒)，恢复后持续这么久没有再摘除时清零摘除次数
+        :param max_ejection_percent: 同时被摘除的地址最多占的百分比
+        :param half_open_requests: HALF_OPEN时同时放行的试探请求数
+        :param failure_codes: 算作地址故障的状态码名称
+        """
+        self.pool = pool
+        self.consecutive_failures = consecutive_failures
+        self.error_rate = error_rate
+        self.window = window
+        self.min_requests = min_requests
+        self.base_ejection = base_ejection
+        self.max_ejection = max_ejection
+        self.max_ejection_percent = max_ejection_percent
+        self.half_open_requests = half_open_requests
+        self.failure_codes = failure_code_set(failure_codes)
+        # 处于HALF_OPEN的地址数，为0时取连接不需要检查试探请求数
+        self.half_open = 0
+        self.breakers = {}
+        self._lock = Lock()
+        self._next_expiry = None
+
+    def get(self, host, port):
+        """
+        获取某个地址的熔断器，不存在时创建
+        :param host:
+        :param port:
+        :return:
+        """
+        address = "%s:%s" % (host, port)
+        breaker = self.breakers.get(address)
+        if breaker is None:
+            with self._lock:
+                breaker = self.breakers.setdefault(address, CircuitBreaker(address))
+        return breaker
+
+    def allow(self, channel):
+        """
+        连接所在的地址是否可以被选取
+        :param channel:
+        :return:
+        """
+        breaker = self.breakers.get("%s:%s" % (channel.host, channel.port))
+        return breaker is None or breaker.state != OPEN
+
+    def admit(self, channel):
+        """
+        选中一个连接后调用，地址处于HALF_OPEN且试探请求已满时返回False
+        :param channel:
+        :return:
+        """
+        breaker = self.breakers.get("%s:%s" % (channel.host, channel.port))
+        if breaker is None or breaker.state != HALF_OPEN:
+            return True
+        with self._lock:
+            if breaker.state != HALF_OPEN:
+                return breaker.state != OPEN
+            if breaker.probes >= self.half_open_requests:
+                return False
+            breaker.probes += 1
+            breaker.probers[channel] = breaker.probers.get(channel, 0) + 1
+            return True
+
+    def probing(self, channel):
+        """
+        连接所在的地址是否处于HALF_OPEN
+        :param channel:
+        :return:
+        """
+        breaker = self.breakers.get("%s:%s" % (channel.host, channel.port))
+        return breaker is not None and breaker.state == HALF_OPEN
+
+    def _leave_half_open(self, breaker):
+        if breaker.state == HALF_OPEN:
+            self.half_open -= 1
+            breaker.probes = 0
+            breaker.probers.clear()
+
+    @staticmethod
+    def _release_probe(breaker, channel):
+        """
+        释放连接在admit中占用的一个试探名额，没有占用(如不经过选取直接使用的连接)时什么都不做，调用方需持有self._lock
+        :param breaker:
+        :param channel:
+        :return:
+        """
+        n = breaker.probers.get(channel)
+        if not n:
+            return
+        if n == 1:
+            del breaker.probers[channel]
+        else:
+            breaker.probers[channel] = n - 1
+        breaker.probes -= 1
+
+    def _can_eject(self):
+        hosts = len(set(zip(self.pool.hosts, self.pool.ports)))
+        ejected = sum(1 for b in self.breakers.values() if b.state == OPEN)
+        return ejected + 1 <= hosts * self.max_ejection_percent / 100.0
+
+    def _eject(self, breaker, now):
+        """
+        摘除一个地址，调用方需持有self._lock
+        :return: 是否摘除
+        """
+        if not self._can_eject():
+            return False
+        if breaker.closed_at is not None and now - breaker.closed_at > self.max_ejection:
+            breaker.ejections = 0
+        self._leave_half_open(breaker)
+        breaker.ejections += 1
+        breaker.state = OPEN
+        breaker.ejected_at = now
+        breaker.ejected_until = now + min(self.base_ejection * breaker.ejections, self.max_ejection)
+        if self._next_expiry is None or breaker.ejected_until < self._next_expiry:
+            self._next_expiry = breaker.ejected_until
+        return True
+
+    def _close(self, breaker, now):
+        self._leave_half_open(breaker)
+        breaker.state = CLOSED
+        breaker.closed_at = now
+        breaker.consecutive_failures = 0
+        breaker.requests = breaker.failures = 0
+        breaker.window_start = now
+
+    def check(self, now=None):
+        """
+        把摘除时间到期的地址改为HALF_OPEN，重新参与选取
+        :return: 是否有地址恢复
+        """
+        now = monotonic() if now is None else now
+        expiry = self._next_expiry
+        if expiry is None or now < expiry:
+            return False
+        changed = False
+        with self._lock:
+            self._next_expiry = None
+            for breaker in self.breakers.values():
+                if breaker.state != OPEN:
+                    continue
+                if breaker.ejected_until <= now:
+                    breaker.state = HALF_OPEN
+                    breaker.probes = 0
+                    breaker.probers.clear()
+                    breaker.ejected_until = None
+                    self.half_open += 1
+                    changed = True
+                elif self._next_expiry is None or breaker.ejected_until < self._next_expiry:
+                    self._next_expiry = breaker.ejected_until
+        if changed:
+            self.pool.breakers_changed()
+        return changed
+
+    def record(self, channel, ok, code=None):
+        """
+        记录一个请求的结果，由ExtendChannel.release调用
+        :param channel:
+        :param ok: 请求是否成功，为None时没有结果(如被取消)
+        :param code: 失败时的状态码，不在failure_codes中的失败不影响熔断
+        :return:
+        """
+        now = monotonic()
+        self.check(now)
+        breaker = self.get(channel.host, channel.port)
+        changed = False
+        with self._lock:
+            if breaker.state == OPEN:
+                # 摘除前已经发出的请求
+                return
+            if not ok and code not in self.failure_codes:
+                # 与地址好坏无关的结果(包括use()等没有结果的释放)只释放这个连接占用的试探名额
+                if breaker.state == HALF_OPEN:
+                    self._release_probe(breaker, channel)
+                return
+            if now - breaker.window_start >= self.window:
+                breaker.requests = breaker.failures = 0
+                breaker.window_start = now
+            breaker.requests += 1
+            if ok:
+                breaker.consecutive_failures = 0
+                if breaker.state == HALF_OPEN:
+                    self._close(breaker, now)
+            else:
+                breaker.failures += 1
+                breaker.consecutive_failures += 1
+                if breaker.state == HALF_OPEN:
+                    changed = self._eject(breaker, now)
+                elif self.consecutive_failures and breaker.consecutive_failures >= self.consecutive_failures:
+                    changed = self._eject(breaker, now)
+                elif self.error_rate is not None and breaker.requests >= self.min_requests \
+                        and breaker.failures >= breaker.requests * self.error_rate:
+                    changed = self._eject(breaker, now)
+        if changed:
+            self.pool.breakers_changed()
+
+    def state(self):
+        """
+        :return: {"host:port": {"state":, "consecutive_failures":, "ejections":, "ejected_for":, "window":}}
+        """
+        with self._lock:
+            return dict((address, breaker.info()) for address, breaker in self.breakers.items())
+
+    def states(self):
+        """
+        每个地址当前的状态，不加锁，供指标抓取等不在请求路径上的读取使用
+        :return: {"host:port": CLOSED/OPEN/HALF_OPEN}
+        """
+        return dict((address, breaker.state) for address, breaker in list(self.breakers.items()))
+
+
+def build_breakers(pool, config):
+    """
+    根据配置创建连接池的熔断器
+    :param pool:
+    :param config: CircuitBreakers的参数，为True时使用默认值，为空时不启用
+    :return: CircuitBreakers 或 None
+    """
+    if not config:
+        return None
+    return CircuitBreakers(pool, **(config if isinstance(config, dict) else {}))
@@ -0,0 +1,125 @@
+from collections import OrderedDict
+from threading import Lock
+from time import monotonic
+
+
+class ResponseCache(object):
+    """
+    带过期时间的LRU响应缓存，key为序列化后的请求
+
+    按条数(max_entries)和/或字节数(max_bytes)限制大小，超出时淘汰最久未使用的条目
+    """
+
+    def __init__(self, ttl=1, max_entries=1024, max_bytes=None):
+        """
+        :param ttl: 过期时间(秒)
+        :param max_entries: 最多缓存的条数，为None时不限制
+        :param max_bytes: 最多缓存的响应字节数，为None时不限制
+        """
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._data = OrderedDict()
+        self._lock = Lock()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key):
+        """
+        获取缓存的响应，不存在或已过期时返回None
+        :param key:
+        :return:
+        """
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                self.misses += 1
+                return None
+            expire, size, value = item
+            if expire <= monotonic():
+                del self._data[key]
+                self.bytes -= size
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value, size=0):
+        """
+        缓存响应
+        :param key:
+        :param value:
+        :param size: 响应的字节数
+        :return:
+        """
+        if self.max_bytes is not None and size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self.bytes -= old[1]
+            self._data[key] = (monotonic() + self.ttl, size, value)
+            self.bytes += size
+            while self._data and ((self.max_entries is not None and len(self._data) > self.max_entries) or
+                                  (self.max_bytes is not None and self.bytes > self.max_bytes)):
+                _, (_, s, _) = self._data.popitem(last=False)
+                self.bytes -= s
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.bytes = 0
+
+    def stats(self):
+        """
+        命中、未命中、淘汰、过期次数以及当前条数和字节数
+        :return:
+        """
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                    "expirations": self.expirations, "entries": len(self._data), "bytes": self.bytes}
+
+    def wrap(self, call):
+        """
+        在调用链上加一层缓存，只缓存不带metadata的请求，命中时返回响应的副本
+        :param call: call(args, kwargs)
+        :return:
+        """
+
+        def cached(args, kwargs):
+            if kwargs.get("metadata") or len(args) != 1:
+                return call(args, kwargs)
+            key = args[0].SerializeToString(deterministic=True)
+            response = self.get(key)
+            if response is None:
+                response = call(args, kwargs)
+                # 缓存副本，调用者(或合并请求的其他调用者)修改返回的响应不会影响缓存
+                cached = type(response)()
+                cached.CopyFrom(response)
+                self.put(key, cached, cached.ByteSize())
+                return response
+            copy = type(response)()
+            copy.CopyFrom(response)
+            return copy
+
+        return cached
+
+
+def build_caches(config):
+    """
+    根据配置创建每个方法的缓存
+    :param config: {方法名: {"ttl": 秒, "max_entries": 条数, "max_bytes": 字节数}}
+    :return: {方法名: ResponseCache}
+    """
+    caches = {}
+    for name, options in (config or {}).items():
+        options = options or {}
+        caches[name] = ResponseCache(ttl=options.get("ttl", 1), max_entries=options.get("max_entries", 1024),
+                                     max_bytes=options.get("max_bytes"))
+    return caches
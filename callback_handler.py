@@ -17,24 +17,29 @@ class DefaultCallBackHandler(object):
         elif state == ChannelConnectivity.IDLE:
             return self.idle(channel)
 
+    def log(self, channel, message):
+        print("[%s] %s" % (channel.name, message))
+
     def shut_down(self, channel):
+        if channel.state == "DEPRECATED":
+            return
         channel.state = "SHUTDOWN"
-        channel.reconnect()
-        print("[%s] server error with shutdown" % channel.connect_id)
+        channel.schedule_reconnect()
+        self.log(channel, "server error with shutdown")
 
     def connecting(self, channel):
         channel.state = "CONNECTING"
-        print("[%s] I am trying to connect server" % channel.connect_id)
+        self.log(channel, "I am trying to connect server")
 
     def ready(self, channel):
         channel.state = "READY"
-        print("[%s] I am ready to send a request" % channel.connect_id)
+        self.log(channel, "I am ready to send a request")
 
     def transient_failure(self, channel):
         channel.state = "TRANSIENT_FAILURE"
-        channel.reconnect()
-        print("[%s] someting wrong with this channel" % channel.connect_id)
+        channel.schedule_reconnect()
+        self.log(channel, "someting wrong with this channel")
 
     def idle(self, channel):
         channel.state = "IDLE"
-        print("[%s] waiting" % channel.connect_id)
+        self.log(channel, "waiting")
@@ -1,15 +1,156 @@
-import time
-from random import randint
-from threading import Lock
+from collections import deque
+from math import exp
+from threading import Lock, Thread
+from time import monotonic, perf_counter, sleep
 from contextlib import contextmanager
 
-from grpc import insecure_channel, intercept_channel
-from grpc import ChannelConnectivity
+from grpc import insecure_channel, intercept_channel, channel_ready_future
+from grpc import ChannelConnectivity, FutureTimeoutError, StatusCode
 
 from .callback_handler import DefaultCallBackHandler
-from .utils import weight_random
+from .balancer import get_balancer
+from .batch import build_batchers
+from .breaker import FAILURE_CODES, build_breakers, failure_code_set
+from .cache import build_caches
+from .coalesce import SingleFlight
+from .timeouts import apply_deadline
+from .errors import Unavailable, status_code
+from .fanout import FanOut
+from .hedge import build_hedgers
+from .metrics import PoolMetrics, build_metrics
+from .retry import build_retriers
+from .reconnect import backoff_delay, default_scheduler
+from .utils import stub_method_paths, weight_random
 
-lock = Lock()
+
+class MethodProxy(object):
+    """
+    调用连接上stub的方法，调用期间增加连接的正在处理请求数，并记录延迟和结果
+    传入方法名时结果也记录到连接池的调用指标中，MethodDispatcher等通过连接池的method_proxy_cls使用这些静态方法
+    """
+    __slots__ = ()
+
+    @staticmethod
+    def invoke(channel, method, args, kwargs, name=None):
+        channel.acquire()
+        start = perf_counter()
+        code = None
+        try:
+            response = method(*args, **kwargs)
+            code = StatusCode.OK
+            return response
+        except Exception as e:
+            code = status_code(e)
+            raise
+        finally:
+            channel.release(perf_counter() - start, code is StatusCode.OK, code, name)
+
+    @staticmethod
+    def invoke_with_call(channel, method, args, kwargs, name=None):
+        channel.acquire()
+        start = perf_counter()
+        code = None
+        try:
+            result = method.with_call(*args, **kwargs)
+            code = StatusCode.OK
+            return result
+        except Exception as e:
+            code = status_code(e)
+            raise
+        finally:
+            channel.release(perf_counter() - start, code is StatusCode.OK, code, name)
+
+    @staticmethod
+    def invoke_future(channel, method, args, kwargs, name=None):
+        channel.acquire()
+        start = perf_counter()
+        try:
+            future = method.future(*args, **kwargs)
+        except Exception as e:
+            channel.release(perf_counter() - start, False, status_code(e), name)
+            raise
+
+        def done(f):
+            # 被取消的调用(如对冲中输掉的一方)不代表连接的好坏，只减少正在处理的请求数
+            if f.cancelled():
+                channel.release(None)
+            else:
+                error = f.exception()
+                channel.release(perf_counter() - start, error is None,
+                                StatusCode.OK if error is None else status_code(error), name)
+
+        future.add_done_callback(done)
+        return future
+
+
+class MethodDispatcher(object):
+    """
+    绑定到连接池和方法名的调度器，每次调用时选取一个连接并调用该连接上stub的方法
+
+    连接池和Manager在收集方法时预先生成，缓存在实例属性上，访问时不再经过__getattr__
+    直接调用时经过连接池为该方法组装的调用链(缓存等)，with_call和future直接发送
+    三种调用都使用该方法的默认超时时间，且不超过当前上下文的截止时间(见timeouts.deadline)
+    """
+    __slots__ = ("pool", "name", "timeout", "_invoke", "_invoke_with_call", "_invoke_future", "_call")
+
+    def __init__(self, pool, name):
+        self.pool = pool
+        self.name = name
+        self.timeout = pool.default_timeout(name)
+        proxy_cls = pool.method_proxy_cls
+        self._invoke = proxy_cls.invoke
+        self._invoke_with_call = proxy_cls.invoke_with_call
+        self._invoke_future = proxy_cls.invoke_future
+        self._call = pool.build_call(name, self._send)
+
+    def _checkout(self):
+        channel = self.pool.get_one_connection()
+        method = channel.stub_methods.get(self.name)
+        if method is None:
+            raise AttributeError("[%s] not defined in %s" % (self.name, channel.stub_cls))
+        return channel, method
+
+    def _send(self, args, kwargs):
+        channel, method = self._checkout()
+        return self._invoke(channel, method, args, kwargs, self.name)
+
+    def __call__(self, *args, **kwargs):
+        return self._call(args, apply_deadline(kwargs, self.timeout))
+
+    def with_call(self, *args, **kwargs):
+        kwargs = apply_deadline(kwargs, self.timeout)
+        channel, method = self._checkout()
+        return self._invoke_with_call(channel, method, args, kwargs, self.name)
+
+    def future(self, *args, **kwargs):
+        kwargs = apply_deadline(kwargs, self.timeout)
+        channel, method = self._checkout()
+        return self._invoke_future(channel, method, args, kwargs, self.name)
+
+    def __repr__(self):
+        return "<%s %s>" % (self.__class__.__name__, self.name)
+
+
+def wait_ready(channels, timeout):
+    """
+    同时等待多个连接建立，所有连接共用一个截止时间
+    :param channels: [ExtendChannel, ]
+    :param timeout: 最长等待时间(秒)
+    :return: {"host:port": {"ready": 已连接数, "total": 连接数}}
+    """
+    deadline = monotonic() + timeout
+    futures = [(c, channel_ready_future(c.grpc_channel)) for c in channels]
+    report = {}
+    for c, future in futures:
+        item = report.setdefault("%s:%s" % (c.host, c.port), {"ready": 0, "total": 0})
+        item["total"] += 1
+        try:
+            future.result(timeout=max(deadline - monotonic(), 0))
+        except FutureTimeoutError:
+            future.cancel()
+        else:
+            item["ready"] += 1
+    return report
 
 
 class ClientConnectionPool:
@@ -24,6 +165,16 @@ class ClientConnectionPool:
 
     callback_handler = DefaultCallBackHandler
     error_handler = None
+    # 连接类，默认为ExtendChannel
+    channel_cls = None
+
+    selectable_state = ("READY", "IDLE")
+    # 负载均衡状态中的连接，BUSY(被use()独占)的连接留在其中只是选取时跳过，切换BUSY不需要重建
+    member_state = ("READY", "IDLE", "BUSY")
+    # 包装stub方法的类
+    method_proxy_cls = MethodProxy
+    method_dispatcher_cls = MethodDispatcher
+    metrics_cls = PoolMetrics
 
     def __init__(self, host="localhost", port=9100, pool_size=5, weights=None, intercept=None, stub_cls=None, **kwargs):
         """
@@ -32,77 +183,404 @@ class ClientConnectionPool:
         :param port: 端口
         :param pool_size: pool大小
         :param intercept: 头部拦截器
+        :param reconnect_loop_time: 重连的初始等待时间(秒)，之后指数增长
+        :param reconnect_max_time: 重连等待时间的上限(秒)
+        :param reconnect_jitter: 重连等待时间的抖动比例
+        :param reconnect_scheduler: 重连调度器，默认使用进程共享的调度器
+        :param balancer: 负载均衡策略，weighted_random(默认)/least_request/p2c/latency 或 Balancer子类
+        :param ewma_decay: 连接延迟和错误率的指数加权移动平均的时间常数(秒)
+        :param checkout_timeout: 没有可用连接时等待的最长时间(秒)，0为立即抛出BlockingIOError
+        :param max_waiters: 同时等待连接的线程数上限，超过时立即抛出BlockingIOError
+        :param cache: 响应缓存，{方法名: {"ttl": 秒, "max_entries": 条数, "max_bytes": 字节数}}
+        :param coalesce: 合并相同并发请求的方法名列表，为True时合并所有方法
+        :param hedge: 对冲请求，{方法名: {"delay": 秒, "percentile": 95, "budget": 0.1, "burst": 10}}
+        :param retry: 重试策略，{方法名: {"codes": ["UNAVAILABLE"], "max_attempts": 3, "backoff": 0.05}}
+        :param retry_budget: 连接池共用的重试预算，{"ratio": 0.1, "max_tokens": 10}
+        :param circuit_breaker: 按地址熔断，CircuitBreakers的参数，如{"consecutive_failures": 5, "error_rate": 0.5}
+        :param default_timeout: 没有传入timeout的调用的默认超时时间(秒)
+        :param method_timeouts: 每个方法的默认超时时间，{方法名: 秒}，优先于default_timeout
+        :param batch: 把单条查询合并为列表查询，{单条方法名: {"list_method": 列表方法名, "key": "id", ...}}
+        :param metrics: 记录调用指标，True 或 {"buckets": [秒, ...]}
         """
         self.methods = set()
         self.pool = []
-        self.hosts = host if isinstance(host, list) else [host, ]
-        self.ports = port if isinstance(port, list) else [port, ]
-        if len(self.hosts) != len(self.ports):
-            raise Exception("length of host[%d] must equal length of port[%d]" % (len(self.hosts), len(self.ports)))
-
-        if len(self.hosts) > 1:
-            self.distribute_mode = True
-        else:
-            self.distribute_mode = False
-
-        if not weights:
-            self.weights = [1 for _ in range(len(self.hosts))]
+        self._set_servers(host, port, weights)
+        # 除服务端列表以外的可选配置，Manager重新加载配置时用来对比
+        self.options = dict((k, v) for k, v in kwargs.items() if k != "reconnect_scheduler")
 
+        self._check_pool_size(len(self.hosts), pool_size)
         self.pool_size = pool_size
         self.intercept = intercept
+        # 指标中的连接池名称，Manager中为配置的name或 "stub#序号"
+        self.name = stub_cls.__name__ if stub_cls else None
+        self.metrics = build_metrics(self, kwargs.pop("metrics", None), self.metrics_cls)
         self.reconnect_loop_time = kwargs.pop("reconnect_loop_time", 5)
+        self.reconnect_max_time = kwargs.pop("reconnect_max_time", 60)
+        self.reconnect_jitter = kwargs.pop("reconnect_jitter", 0.5)
+        self.reconnect_scheduler = kwargs.pop("reconnect_scheduler", None) or default_scheduler()
+        self.ewma_decay = kwargs.pop("ewma_decay", 5)
+        self.checkout_timeout = kwargs.pop("checkout_timeout", 0)
+        self.max_waiters = kwargs.pop("max_waiters", 128)
+        self.timeout = kwargs.pop("default_timeout", None)
+        self.method_timeouts = kwargs.pop("method_timeouts", None) or {}
+        self.caches = build_caches(kwargs.pop("cache", None))
+        self.coalesce = kwargs.pop("coalesce", None) or ()
+        self.single_flight = SingleFlight()
+        self.batchers = build_batchers(kwargs.pop("batch", None), self._list_call)
+        self.breakers = build_breakers(self, kwargs.pop("circuit_breaker", None))
+        # 计入连接错误率的状态码，与熔断使用同一组
+        if self.breakers is not None:
+            self.failure_codes = self.breakers.failure_codes
+        else:
+            self.failure_codes = failure_code_set(FAILURE_CODES)
+        self.hedgers = build_hedgers(self, kwargs.pop("hedge", None))
+        self.retriers, self.retry_budget = build_retriers(self, kwargs.pop("retry", None),
+                                                          kwargs.pop("retry_budget", None), self.hedgers)
         # if self.callback_handler is not None:
         #     self.callback_handler = self.callback_handler()
 
         self.stub_cls = stub_cls
+        # 方法名 -> 完整路径 "/Service/Method"
+        self.method_paths = dict(stub_method_paths(stub_cls)) if stub_cls else {}
+        # 每个连接池独立的锁，只保护选取状态，不同连接池之间不会互相竞争
+        self._lock = Lock()
+        # 等待可用连接的线程队列，每个线程一把锁作为条件变量，连接状态变为READY/IDLE时按先后顺序唤醒
+        self._waiters = deque()
+        self.wait_stats = {"count": 0, "total": 0.0, "max": 0.0, "timeout": 0, "rejected": 0}
+        # 负载均衡策略包含READY/IDLE/BUSY的连接(只选取READY/IDLE)，这个集合或权重变化时标记为脏，下次选取时重建
+        self.balancer = get_balancer(kwargs.pop("balancer", None), self)
+        self._selector_dirty = True
+        # 连接索引: id/名称 -> 连接，(host, port) -> {连接}，状态 -> {连接}，在连接状态变化时原地更新
+        self._by_id = {}
+        self._by_address = {}
+        self._by_state = {}
         # 初始化连接池
         self._init_pool()
         self.status = self._STATUS_OK
 
+    def _set_servers(self, host, port, weights):
+        """
+        校验并设置服务端地址和权重
+        :param host: ip或ip列表
+        :param port: 端口或端口列表
+        :param weights: 权重列表
+        :return:
+        """
+        hosts = host if isinstance(host, list) else [host, ]
+        ports = port if isinstance(port, list) else [port, ]
+        if len(hosts) != len(ports):
+            raise Exception("length of host[%d] must equal length of port[%d]" % (len(hosts), len(ports)))
+
+        if not weights:
+            weights = [1 for _ in range(len(hosts))]
+        weights = [1 if w is None else w for w in weights]
+        if len(weights) != len(hosts):
+            raise Exception("length of weights[%d] must equal length of host[%d]" % (len(weights), len(hosts)))
+
+        self.hosts = hosts
+        self.ports = ports
+        self.weights = weights
+        self.distribute_mode = len(hosts) > 1
+
+    @staticmethod
+    def _check_pool_size(hosts, pool_size):
+        """
+        每个地址至少要有一个连接，否则有的地址永远不会被选中
+        :param hosts: 地址数
+        :param pool_size: 连接数，为0时关闭所有连接
+        :return:
+        """
+        if 0 < pool_size < hosts:
+            raise Exception("pool_size[%d] must not be less than the number of hosts[%d]" % (pool_size, hosts))
+
+    def _plan(self):
+        """
+        把pool_size个连接轮流分配到各个地址，地址的权重平分给它的连接，各地址的流量比例与配置的权重一致
+        :return: {(host, port): (连接数, 每个连接的权重)}
+        """
+        plan = {}
+        n = len(self.hosts)
+        for i in range(n):
+            plan[(self.hosts[i], self.ports[i])] = [0, self.weights[i]]
+        for i in range(self.pool_size):
+            plan[(self.hosts[i % n], self.ports[i % n])][0] += 1
+        return dict((k, (size, weight / size if size else weight)) for k, (size, weight) in plan.items())
+
+    def _new_channel(self, host, port, weight):
+        channel_cls = self.channel_cls or ExtendChannel
+        return channel_cls(self, ExtendChannel.next_connect_id(), host, port, self.callback_handler,
+                           self.intercept, self.reconnect_loop_time, self.stub_cls, weight=weight)
+
     def _init_pool(self):
         """
         连接池初始化方法
         :return:
         """
-        self.pool = set()
+        pool = set()
 
-        for size in range(self.pool_size):
-            n = randint(0, len(self.hosts) - 1)
-            host = self.hosts[n]
-            port = self.ports[n]
-            weight = self.weights[n]
+        for (host, port), (size, weight) in self._plan().items():
+            for _ in range(size):
+                pool.add(self._new_channel(host, port, weight))
 
-            channel = ExtendChannel(self, ExtendChannel.connect_id, host, port, self.callback_handler, self.intercept,
-                                    self.reconnect_loop_time, self.stub_cls, weight=weight)
-            ExtendChannel.connect_id += 1
+        with self._lock:
+            self.pool = pool
+            self._by_id = {}
+            self._by_address = {}
+            self._by_state = {}
+            for channel in pool:
+                self._index(channel)
+            self._selector_dirty = True
+
+    def _index(self, channel):
+        """
+        把连接加入索引，调用方需持有self._lock
+        :param channel:
+        :return:
+        """
+        self._by_id[channel.connect_id] = channel
+        self._by_id[channel.name] = channel
+        self._by_address.setdefault((channel.host, channel.port), set()).add(channel)
+        channel.indexed_state = channel.state
+        self._by_state.setdefault(channel.state, set()).add(channel)
 
-            self.pool.add(channel)
+    def _unindex(self, channel):
+        """
+        把连接移出索引，调用方需持有self._lock
+        :param channel:
+        :return:
+        """
+        self._by_id.pop(channel.connect_id, None)
+        self._by_id.pop(channel.name, None)
+        channels = self._by_address.get((channel.host, channel.port))
+        if channels is not None:
+            channels.discard(channel)
+            if not channels:
+                del self._by_address[(channel.host, channel.port)]
+        channels = self._by_state.get(channel.indexed_state)
+        if channels is not None:
+            channels.discard(channel)
 
     def get_connection(self, conn_id):
         """
         通过连接id获取连接对象
-        :param conn_id: 连接对象的id
+        :param conn_id: 连接对象的id，整数id或 "id:StubName" 形式的名称
         :return:
         """
-        for c in self.pool:
-            if c.connect_id == conn_id:
-                return c
-        return None
+        return self._by_id.get(conn_id)
 
-    def get_one_connection(self):
+    def get_connections(self, host, port):
         """
-        随机获取一个连接对象
+        获取连接到某个地址的所有连接
+        :param host:
+        :param port:
         :return:
         """
-        with lock:
-            ready_rand = []
-            for conn in self.pool:
-                if conn.state in ("READY", "IDLE"):
-                    ready_rand.append(conn)
+        return list(self._by_address.get((host, port), ()))
 
-            if not ready_rand:
+    def get_connections_by_state(self, state):
+        """
+        获取处于某个状态的所有连接
+        :param state: 状态名称，如 READY
+        :return:
+        """
+        return list(self._by_state.get(state, ()))
+
+    def count_by_state(self):
+        """
+        各状态的连接数
+        :return:
+        """
+        return dict((state, len(channels)) for state, channels in list(self._by_state.items()) if channels)
+
+    def get_one_connection(self, timeout=None):
+        """
+        随机获取一个连接对象，没有可用连接时最多等待timeout秒
+        :param timeout: 等待时间(秒)，为None时使用checkout_timeout
+        :return:
+        """
+        if self._waiters:
+            if timeout is None:
+                timeout = self.checkout_timeout
+            if timeout and timeout > 0:
+                # 已经有线程在排队，新来的线程排到队尾，不抢先取走刚释放的连接
+                return self._wait_connection(timeout)
+        if self._selector_dirty:
+            with self._lock:
+                if self._selector_dirty:
+                    self._rebuild_selector()
+        conn = self._pick()
+        if conn is None:
+            if self.breakers is not None:
+                self.breakers.check()
+            # 其他线程可能正在重建选取状态(脏标记已清除)，等它重建完成后再取一次
+            with self._lock:
+                if self._selector_dirty:
+                    self._rebuild_selector()
+            conn = self._pick()
+        if conn is None:
+            if timeout is None:
+                timeout = self.checkout_timeout
+            if not timeout or timeout <= 0:
+                if self.metrics is not None:
+                    self.metrics.observe_checkout(0.0)
                 raise BlockingIOError("All connection are busy")
-            return weight_random(self.pool, key="weight")
+            return self._wait_connection(timeout)
+        # 不需要等待的取连接也要记录，否则等待时间的分布只包含排队的调用
+        if self.metrics is not None:
+            self.metrics.observe_checkout(0.0)
+        return conn
+
+    def _pick(self):
+        """
+        用负载均衡策略选取一个连接，有地址处于HALF_OPEN时只放行有限的试探请求
+        :return:
+        """
+        conn = self.balancer.pick()
+        breakers = self.breakers
+        if conn is None or breakers is None or not breakers.half_open:
+            return conn
+        for _ in range(3):
+            if breakers.admit(conn):
+                return conn
+            conn = self.balancer.pick()
+            if conn is None:
+                return None
+        # 多次选中试探名额已满的地址，从其他可用连接中选
+        return weight_random(c for c in self.pool if self.usable(c) and not breakers.probing(c))
+
+    def _wait_connection(self, timeout):
+        """
+        排队等待可用连接，先到先得
+        :param timeout: 等待时间(秒)
+        :return:
+        """
+        start = monotonic()
+        deadline = start + timeout
+        stats = self.wait_stats
+        with self._lock:
+            if len(self._waiters) >= self.max_waiters:
+                stats["rejected"] += 1
+                raise BlockingIOError("Too many waiters for connection [%d]" % len(self._waiters))
+            waiter = Lock()
+            waiter.acquire()
+            self._waiters.append(waiter)
+            try:
+                while True:
+                    # 只有队首的线程可以取连接，避免后来的线程插队
+                    if self._waiters[0] is waiter:
+                        if self._selector_dirty:
+                            self._rebuild_selector()
+                        conn = self._pick()
+                        if conn is not None:
+                            return conn
+                    remaining = deadline - monotonic()
+                    if remaining <= 0:
+                        stats["timeout"] += 1
+                        raise BlockingIOError("All connection are busy after waiting %.3fs" % timeout)
+                    self._lock.release()
+                    try:
+                        waiter.acquire(True, remaining)
+                    finally:
+                        self._lock.acquire()
+            finally:
+                self._waiters.remove(waiter)
+                if self._waiters:
+                    self._wake_waiter()
+                elapsed = monotonic() - start
+                stats["count"] += 1
+                stats["total"] += elapsed
+                if self.metrics is not None:
+                    self.metrics.observe_checkout(elapsed)
+                if elapsed > stats["max"]:
+                    stats["max"] = elapsed
+
+    def _wake_waiter(self):
+        """
+        唤醒队首的等待线程，调用方需持有self._lock
+        :return:
+        """
+        waiter = self._waiters[0]
+        if waiter.locked():
+            waiter.release()
+
+    def get_wait_stats(self):
+        """
+        排队等待连接的统计: 次数、总耗时、最长耗时(秒)、超时次数、因队列已满被拒绝的次数
+        :return:
+        """
+        with self._lock:
+            stats = dict(self.wait_stats)
+            stats["waiting"] = len(self._waiters)
+        return stats
+
+    def _rebuild_selector(self):
+        """
+        用当前可选取的连接重建负载均衡状态，调用方需持有self._lock
+        先清除脏标记再重建，重建期间发生的状态变化会在下次选取时再次重建
+        :return:
+        """
+        self._selector_dirty = False
+        self.balancer.rebuild([conn for conn in self.pool if self.member(conn)])
+
+    def member(self, channel):
+        """
+        连接是否应该在负载均衡状态中: READY/IDLE/BUSY且所在地址没有被熔断
+        :param channel:
+        :return:
+        """
+        return channel.state in self.member_state and (self.breakers is None or self.breakers.allow(channel))
+
+    def usable(self, channel):
+        """
+        连接是否可以被选取: 状态可用且所在地址没有被熔断
+        :param channel:
+        :return:
+        """
+        return channel.state in self.selectable_state and (self.breakers is None or self.breakers.allow(channel))
+
+    def breakers_changed(self):
+        """
+        有地址被熔断或恢复时由CircuitBreakers调用
+        :return:
+        """
+        self._selector_dirty = True
+        with self._lock:
+            if self._waiters:
+                self._wake_waiter()
+
+    def get_breaker_state(self):
+        """
+        每个地址的熔断状态，没有启用熔断时返回空字典
+        :return: {"host:port": {"state": CLOSED/OPEN/HALF_OPEN, "ejections":, "ejected_for":, ...}}
+        """
+        return self.breakers.state() if self.breakers is not None else {}
+
+    def channel_changed(self, channel):
+        """
+        连接的状态或权重发生变化时由ExtendChannel调用，更新状态索引，连接变为可用时唤醒等待的线程
+        只在负载均衡状态中的连接集合或权重变化时标记重建，BUSY和READY/IDLE之间的切换O(1)更新
+        :param channel:
+        :return:
+        """
+        with self._lock:
+            # 以当前状态为准，多个线程的状态变化乱序到达也不会把索引改错
+            state = channel.state
+            if self._by_id.get(channel.connect_id) is channel and channel.indexed_state != state:
+                old = channel.indexed_state
+                channels = self._by_state.get(old)
+                if channels is not None:
+                    channels.discard(channel)
+                self._by_state.setdefault(state, set()).add(channel)
+                channel.indexed_state = state
+                if old not in self.member_state or state not in self.member_state:
+                    self._selector_dirty = True
+                elif old == "BUSY" or state == "BUSY":
+                    self.balancer.set_busy(channel, state == "BUSY")
+            else:
+                self._selector_dirty = True
+            # 连接重新可用(连接建立、use()结束时从BUSY恢复)时唤醒队首的等待线程
+            if self._waiters and state in self.selectable_state:
+                self._wake_waiter()
 
     def get_connection_state(self, conn_id):
         """
@@ -132,17 +610,116 @@ class ClientConnectionPool:
         for c in self.pool:
             c.close()
 
-    def start_all(self):
+    def reconnect_delay(self, attempt):
+        """
+        第attempt次重连前的等待时间
+        :param attempt:
+        :return:
+        """
+        return backoff_delay(attempt, self.reconnect_loop_time, self.reconnect_max_time, self.reconnect_jitter)
+
+    def start_all(self, drain_timeout=30):
         """
-        重新开启连接池中的所有连接
+        重新开启连接池中的所有连接，旧连接与update中被删除的连接一样在后台等请求结束后关闭
+        :param drain_timeout: 等待旧连接上的请求结束的最长时间(秒)
         :return:
         """
+        old = list(self.pool)
         self._init_pool()
+        if old:
+            self.drain(old, drain_timeout)
+
+    def update(self, host=None, port=None, weights=None, pool_size=None, drain_timeout=30):
+        """
+        在线修改服务端列表、权重和连接数，只为新增的地址建立连接，删除的地址在后台等请求结束后关闭，权重原地修改
+        :param host: ip或ip列表，为None时不修改服务端列表
+        :param port: 端口或端口列表
+        :param weights: 权重列表
+        :param pool_size: 连接数，为None时不修改
+        :param drain_timeout: 等待被删除连接上的请求结束的最长时间(秒)
+        :return: {"added": [连接], "removed": [连接], "reweighted": [连接]}
+        """
+        hosts = len(self.hosts) if host is None else len(host if isinstance(host, list) else [host])
+        self._check_pool_size(hosts, self.pool_size if pool_size is None else pool_size)
+        if host is not None:
+            self._set_servers(host, port, weights)
+        if pool_size is not None:
+            self.pool_size = pool_size
+        plan = self._plan()
+
+        added = []
+        removed = []
+        reweighted = []
+        current = {}
+        for c in self.pool:
+            current.setdefault((c.host, c.port), []).append(c)
+
+        for address, channels in current.items():
+            size, weight = plan.get(address, (0, None))
+            # 优先保留可用的连接
+            channels.sort(key=lambda c: c.state not in self.selectable_state)
+            removed.extend(channels[size:])
+            for c in channels[:size]:
+                if c.weight != weight:
+                    c.weight = weight
+                    reweighted.append(c)
+        for (host, port), (size, weight) in plan.items():
+            for _ in range(size - len(current.get((host, port), ()))):
+                added.append(self._new_channel(host, port, weight))
+
+        if added or removed:
+            with self._lock:
+                pool = set(self.pool)
+                pool.difference_update(removed)
+                pool.update(added)
+                for c in removed:
+                    self._unindex(c)
+                for c in added:
+                    self._index(c)
+                self.pool = pool
+                self._selector_dirty = True
+                if self._waiters and added:
+                    self._wake_waiter()
+        if removed:
+            self.drain(removed, drain_timeout)
+        return {"added": added, "removed": removed, "reweighted": reweighted}
+
+    def drain(self, channels, timeout):
+        """
+        在后台线程中等待连接上的请求结束后关闭连接
+        :param channels: 已经移出连接池的连接
+        :param timeout: 最长等待时间(秒)
+        :return:
+        """
+        drainer = Thread(target=self._drain, args=(channels, timeout), name="grpc-pool-drain", daemon=True)
+        drainer.start()
+
+    @staticmethod
+    def _drain(channels, timeout):
+        """
+        等待连接上的请求结束后关闭连接
+        :param channels:
+        :param timeout: 最长等待时间(秒)
+        :return:
+        """
+        deadline = monotonic() + timeout
+        while any(c.inflight for c in channels) and monotonic() < deadline:
+            sleep(0.05)
+        for c in channels:
+            c.close()
+
+    def warm_up(self, timeout=5):
+        """
+        同时建立所有连接，最多等待timeout秒
+        :param timeout:
+        :return: {"host:port": {"ready": 已连接数, "total": 连接数}}
+        """
+        return wait_ready(list(self.pool), timeout)
 
     def get_all_channel_state(self):
         d = {}
         for channel in self.pool:
-            d[channel.connect_id] = channel.state
+            d[channel.name] = channel.state
         return d
 
     def get_stub(self, stub_cls):
@@ -155,16 +732,170 @@ class ClientConnectionPool:
         stub = stub_cls(conn)
         return stub
 
+    def default_timeout(self, name):
+        """
+        某个方法的默认超时时间
+        :param name: 方法名
+        :return: 秒，为None时不限制
+        """
+        return self.method_timeouts.get(name, self.timeout)
+
+    def build_call(self, name, send):
+        """
+        组装某个方法的调用链，每一层都是 call(args, kwargs)
+        :param name: 方法名
+        :param send: 选取连接并发送请求
+        :return:
+        """
+        call = self.retriers.get(name) or self.hedgers.get(name) or send
+        batcher = self.batchers.get(name)
+        if batcher is not None:
+            call = batcher.wrap(call)
+        if self.coalesce is True or name in self.coalesce:
+            call = self.single_flight.wrap(name, call)
+        cache = self.caches.get(name)
+        if cache is not None:
+            call = cache.wrap(call)
+        return call
+
+    def other_connection(self, channel, exclude=None):
+        """
+        按权重选取一个连接到其他地址的可用连接，没有其他地址时选取同一地址的其他连接
+        :param channel: 要避开的连接
+        :param exclude: 同样要避开的地址集合 {(host, port)}
+        :return: ExtendChannel 或 None
+        """
+        usable = [c for c in self.pool if c is not channel and self.usable(c)]
+        avoid = {(channel.host, channel.port)} | set(exclude or ())
+        others = [c for c in usable if (c.host, c.port) not in avoid]
+        return weight_random(others or usable)
+
+    def connection_excluding(self, exclude):
+        """
+        按权重选取一个不在exclude中的地址的可用连接，所有可用连接都在exclude中时按负载均衡策略选取
+        :param exclude: 要避开的地址集合 {(host, port)}，如重试时已经失败的地址
+        :return: ExtendChannel
+        """
+        if exclude:
+            others = [c for c in self.pool if self.usable(c) and (c.host, c.port) not in exclude]
+            if others:
+                return weight_random(others)
+        return self.get_one_connection()
+
+    def hedge_stats(self):
+        """
+        每个方法的对冲统计
+        :return: {方法名: {"calls":, "hedged":, "hedge_wins":, "delay":, "budget":}}
+        """
+        return dict((name, hedger.stats()) for name, hedger in self.hedgers.items())
+
+    def retry_stats(self):
+        """
+        每个方法的重试统计和连接池的重试预算
+        :return: {"budget": {...}, "methods": {方法名: {"retries":, "exhausted":, "throttled":}}}
+        """
+        return {"budget": self.retry_budget.stats(),
+                "methods": dict((name, retrier.stats()) for name, retrier in self.retriers.items())}
+
+    def _address_channel(self, host, port):
+        """
+        选取连接到某个地址的可用连接中进行中请求最少的一个
+        :param host:
+        :param port:
+        :return: ExtendChannel 或 None
+        """
+        channels = [c for c in self.get_connections(host, port) if self.usable(c)]
+        return min(channels, key=lambda c: c.inflight) if channels else None
+
+    def scatter(self, method, requests_by_host, timeout=None, **kwargs):
+        """
+        同时向多个地址发送各自的请求，迭代返回值可按完成顺序取得结果
+        :param method: 方法名
+        :param requests_by_host: {"host:port": 请求}
+        :param timeout: 超时时间(秒)
+        :param kwargs: 其他调用参数，如metadata
+        :return: FanOut
+        """
+        if method not in self.methods:
+            raise AttributeError("[%s] not defined in %s" % (method, self.__class__))
+        kwargs["timeout"] = timeout
+        kwargs = apply_deadline(kwargs, self.default_timeout(method))
+        timeout = kwargs["timeout"]
+        if timeout is None:
+            kwargs.pop("timeout")
+        fanout = FanOut(timeout)
+        for address, request in requests_by_host.items():
+            host, port = address.rsplit(":", 1)
+            channel = self._address_channel(host, int(port))
+            if channel is None:
+                fanout.add_error(address, Unavailable("no available connection to %s" % address))
+                continue
+            try:
+                future = self.method_proxy_cls.invoke_future(channel, channel.stub_methods[method], (request,), kwargs,
+                                                             method)
+            except Exception as e:
+                fanout.add_error(address, e)
+            else:
+                fanout.add(address, future)
+        return fanout
+
+    def broadcast(self, method, request, timeout=None, **kwargs):
+        """
+        向连接池的每个地址发送同一个请求，如清除缓存或收集各分片的结果
+        :param method: 方法名
+        :param request: 请求
+        :param timeout: 超时时间(秒)
+        :param kwargs: 其他调用参数，如metadata
+        :return: FanOut
+        """
+        requests_by_host = dict(("%s:%s" % address, request) for address in zip(self.hosts, self.ports))
+        return self.scatter(method, requests_by_host, timeout, **kwargs)
+
+    def _list_call(self, name):
+        """
+        批量合并使用的列表方法调用，发送时才获取调度器，经过列表方法自己的调用链
+        :param name: 列表方法名
+        :return:
+        """
+
+        def call(args, kwargs):
+            return self.dispatcher(name)._call(args, kwargs)
+
+        return call
+
+    def batch_stats(self):
+        """
+        每个方法的批量合并统计
+        :return: {方法名: {"requests":, "batches":}}
+        """
+        return dict((name, batcher.stats()) for name, batcher in self.batchers.items())
+
+    def cache_stats(self):
+        """
+        每个方法的响应缓存统计
+        :return: {方法名: {"hits":, "misses":, "evictions":, "expirations":, "entries":, "bytes":}}
+        """
+        return dict((name, cache.stats()) for name, cache in self.caches.items())
+
+    def dispatcher(self, item):
+        """
+        获取某个方法的调度器，第一次获取时生成并缓存在实例属性上
+        :param item: 方法名
+        :return:
+        """
+        dispatcher = self.__dict__.get(item)
+        if dispatcher is None:
+            if item not in self.methods:
+                raise AttributeError("[%s] not defined in %s" % (item, self.__class__))
+            dispatcher = self.method_dispatcher_cls(self, item)
+            # 不覆盖连接池自身的属性和方法
+            if not hasattr(type(self), item):
+                self.__dict__[item] = dispatcher
+        return dispatcher
+
     def __getattr__(self, item):
         if item in self.methods:
-            # return self.methods[item]
-            # 获取一个channel
-            # 使用这个channel的stub去发送请求
-            c = self.get_one_connection()
-            method = getattr(c.stub, item, None)
-            if not method:
-                raise AttributeError("[%s] not defined in %s" % (item, self.__class__))
-            return method
+            return self.dispatcher(item)
         else:
             raise AttributeError("[%s] not defined in %s" % (item, self.__class__))
 
@@ -176,53 +907,112 @@ class ExtendChannel(object):
     extra_state = ['INITIALIZING', "DEPRECATED", "BUSY"]
 
     connect_id = 0
+    _connect_id_lock = Lock()
+
+    @classmethod
+    def next_connect_id(cls):
+        """
+        分配一个全局唯一的连接id
+        :return:
+        """
+        with ExtendChannel._connect_id_lock:
+            connect_id = ExtendChannel.connect_id
+            ExtendChannel.connect_id += 1
+            return connect_id
 
     def __init__(self, pool, connect_id, host, port, callback_handler, intercept, reconnect_loop_time, stub_cls=None,
                  **kwargs):
         """
         初始化
-        :param connect_id: 连接id
+        :param connect_id: 连接id，整数，name为 "id:StubName"
         :param host: 域名
         :param port: 端口
         :param callback_handler: 回调handler
         :param intercept: 头部拦截器
         """
-        if pool:
-            self.pool = pool
+        self.pool = pool
+        # 每个连接独立的锁，保护状态和正在处理的请求数
+        self._lock = Lock()
+        self._state = "INITIALIZING"
+        self.inflight = 0
+        # 是否被use()独占
+        self.checked_out = False
+        # 按时间衰减的延迟(秒)和错误率的移动平均，没有样本时为None
+        self.latency_ewma = None
+        self.error_ewma = None
+        self._ewma_time = None
+        self._weight = kwargs.pop("weight", 1)
+        self.reconnect_attempts = 0
+        self.reconnect_pending = False
 
         self.connect_id = connect_id
+        self.stub_methods = {}
+        # 方法名 -> 调用指标的key，见PoolMetrics.observe_call
+        self.metric_keys = {}
+        self.name = str(connect_id)
+        self.indexed_state = None
         self.intercept = intercept
         self.host = host
         self.port = port
         self._channel = self.connect()
         self.callback_handler = callback_handler(self._channel)
         self.reconnect_loop_time = reconnect_loop_time
-        if not self._channel:
-            self.reconnect()
-        self._channel.subscribe(self.callback)
-        self._state = "IDLE"
+        self.watch(self._channel)
+        self._set_state("IDLE")
 
+        self.stub_cls = stub_cls
         if stub_cls:
             self.stub = self.init_stub(stub_cls)
-            self.connect_id = str(self.connect_id) + ":" + stub_cls.__name__
+            self.name = "%s:%s" % (self.connect_id, stub_cls.__name__)
 
-        self._weight = kwargs.pop("weight", 1)
+    def schedule_reconnect(self):
+        """
+        交给重连调度器在后台重连，立即返回，不阻塞回调线程
+        :return:
+        """
+        if self._state == "DEPRECATED":
+            return
+        if self.pool:
+            scheduler = self.pool.reconnect_scheduler
+            delay = self.pool.reconnect_delay(self.reconnect_attempts)
+        else:
+            scheduler = default_scheduler()
+            delay = backoff_delay(self.reconnect_attempts, self.reconnect_loop_time)
+        if scheduler.schedule(self, delay):
+            self.reconnect_attempts += 1
 
     def reconnect(self):
         """
-        重新连接
+        重新连接，由重连调度器调用，只尝试一次，失败后的重试由连接状态回调再次调度
         :return:
         """
-        while True:
-            time.sleep(self.reconnect_loop_time)
-            try:
-                self._channel = self.connect()
-            except:
-                pass
-            else:
-                if self._channel:
-                    self._state = "IDLE"
-                    break
+        if self._state == "DEPRECATED":
+            return
+        old = self._channel
+        channel = self.connect()
+        self._channel = channel
+        self.watch(channel, try_to_connect=True)
+        if self.stub_cls:
+            self.stub = self.init_stub(self.stub_cls)
+        self.unwatch(old)
+        old.close()
+
+    def watch(self, channel, try_to_connect=False):
+        """
+        订阅channel的连接状态变化
+        :param channel: grpc channel
+        :param try_to_connect: 是否立即开始连接
+        :return:
+        """
+        channel.subscribe(self.callback, try_to_connect=try_to_connect)
+
+    def unwatch(self, channel):
+        """
+        取消订阅channel的连接状态变化
+        :param channel: grpc channel
+        :return:
+        """
+        channel.unsubscribe(self.callback)
 
     def connect(self):
         """
@@ -242,8 +1032,19 @@ class ExtendChannel(object):
         关闭
         :return:
         """
+        self._set_state("DEPRECATED")
+        if self.pool:
+            self.pool.reconnect_scheduler.cancel(self)
+        self.unwatch(self._channel)
         self._channel.close()
-        self._state = "DEPRECATED"
+
+    @property
+    def grpc_channel(self):
+        """
+        当前使用的grpc channel
+        :return:
+        """
+        return self._channel
 
     @property
     def state(self):
@@ -263,7 +1064,22 @@ class ExtendChannel(object):
         temp = getattr(ChannelConnectivity, value, None)
         if temp is None and value not in self.extra_state:
             raise ValueError("Value Name Must in ChannelConnectivity")
-        self._state = value
+        self._set_state(value)
+
+    def _set_state(self, value):
+        """
+        修改状态，状态变化时通知连接池
+        :param value:
+        :return:
+        """
+        with self._lock:
+            if value == self._state:
+                return
+            self._state = value
+            if value == "READY":
+                self.reconnect_attempts = 0
+        if self.pool:
+            self.pool.channel_changed(self)
 
     @property
     def weight(self):
@@ -271,7 +1087,11 @@ class ExtendChannel(object):
 
     @weight.setter
     def weight(self, val):
+        if val == self._weight:
+            return
         self._weight = val
+        if self.pool:
+            self.pool.channel_changed(self)
 
     def callback(self, *args, **kwargs):
         """
@@ -279,34 +1099,105 @@ class ExtendChannel(object):
         :return:
         """
         state = args[0]
+        if self._state == "DEPRECATED":
+            return
         if self.callback_handler:
-            with lock:
-                return self.callback_handler.dispatch(self, state)
+            return self.callback_handler.dispatch(self, state)
+
+    def acquire(self):
+        """
+        正在处理的请求数+1
+        :return:
+        """
+        with self._lock:
+            self.inflight += 1
+
+    def release(self, latency=None, ok=True, code=None, name=None):
+        """
+        正在处理的请求数-1，并记录本次请求的延迟和结果
+        :param latency: 请求耗时(秒)，为None时不记录
+        :param ok: 请求是否成功
+        :param code: grpc状态码，非grpc错误时为None
+        :param name: 方法名，为None时不记录到调用指标
+        :return:
+        """
+        with self._lock:
+            self.inflight -= 1
+            if latency is not None:
+                self._record(latency, code)
+            idle = self._idle_after_use()
+        pool = self.pool
+        if pool is None:
+            return
+        if idle:
+            pool.channel_changed(self)
+        breakers = pool.breakers
+        if breakers is not None and (latency is not None or breakers.half_open):
+            # 没有结果的请求也要释放HALF_OPEN的试探名额
+            breakers.record(self, ok if latency is not None else None, code)
+        metrics = pool.metrics
+        if metrics is not None and name is not None and latency is not None:
+            metrics.observe_call(name, self, latency, code)
+
+    def _record(self, latency, code):
+        """
+        更新延迟和错误率的移动平均，调用方需持有self._lock
+        只有连接池failure_codes中的状态码算作错误，NOT_FOUND等业务错误不影响错误率
+        """
+        now = monotonic()
+        error = 1.0 if self.pool and code in self.pool.failure_codes else 0.0
+        if self._ewma_time is None:
+            self.latency_ewma = latency
+            self.error_ewma = error
+        else:
+            decay = self.pool.ewma_decay if self.pool else 5
+            alpha = 1 - exp(-max(now - self._ewma_time, 0) / decay)
+            # 短时间内连续的请求也要有最小的权重，避免高QPS时移动平均停滞
+            alpha = max(alpha, 0.01)
+            self.latency_ewma += alpha * (latency - self.latency_ewma)
+            self.error_ewma += alpha * (error - self.error_ewma)
+        self._ewma_time = now
+
+    def _idle_after_use(self):
+        """
+        use()结束且没有正在处理的请求时从BUSY回到IDLE，调用时需持有self._lock
+        use()期间设置的其他状态(如TRANSIENT_FAILURE)保持不变
+        :return: 状态是否改为IDLE
+        """
+        if self._state != "BUSY" or self.checked_out or self.inflight:
+            return False
+        self._state = "IDLE"
+        return True
 
     def _busy(self):
-        with lock:
-            self._state = "BUSY"
+        with self._lock:
+            self.checked_out = True
+        self.acquire()
+        self._set_state("BUSY")
 
     def _free(self):
-        with lock:
-            self._state = "IDLE"
+        with self._lock:
+            self.checked_out = False
+        self.release()
 
     @contextmanager
     def use(self):
         self._busy()
-        yield
-        self._free()
+        try:
+            yield
+        finally:
+            self._free()
 
     def init_stub(self, stub_cls):
         temp = stub_cls(self._channel)
+        self.stub_methods = dict((k, v) for k, v in temp.__dict__.items() if not k.startswith("__"))
         self.notify(temp)
         return temp
 
     def notify(self, stub_instance):
         if self.pool:
-            for k, v in stub_instance.__dict__.items():
-                if not k.startswith("__"):
-                    self.pool.methods.add(k)
+            for k in self.stub_methods:
+                self.pool.methods.add(k)
 
     def __getattr__(self, item):
         return getattr(self._channel, item, None)
@@ -0,0 +1,90 @@
+from threading import Event, Lock
+
+from .errors import DeadlineExceeded
+
+
+class _Flight(object):
+    __slots__ = ("event", "response", "error")
+
+    def __init__(self):
+        self.event = Event()
+        self.response = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """
+    合并相同的并发请求: 同一个key同时只发送一次，其他调用等待并共享结果(或异常)
+    """
+
+    def __init__(self):
+        self._flights = {}
+        self._lock = Lock()
+        self.leaders = 0
+        self.followers = 0
+
+    def do(self, key, fn, timeout=None):
+        """
+        执行fn，同一个key已有正在进行的调用时等待它的结果
+        :param key:
+        :param fn: 无参数的调用
+        :param timeout: 等待其他调用结果的最长时间(秒)
+        :return: (结果, 是否为发起者)
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is None:
+                flight = _Flight()
+                self._flights[key] = flight
+                self.leaders += 1
+                leader = True
+            else:
+                self.followers += 1
+                leader = False
+
+        if not leader:
+            if not flight.event.wait(timeout):
+                raise DeadlineExceeded("Deadline Exceeded while waiting for an identical in-flight call")
+            if flight.error is not None:
+                raise flight.error
+            return flight.response, False
+
+        try:
+            flight.response = fn()
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.event.set()
+        return flight.response, True
+
+    def stats(self):
+        """
+        发起的调用数和合并到其他调用上的调用数
+        :return:
+        """
+        with self._lock:
+            return {"leaders": self.leaders, "followers": self.followers, "in_flight": len(self._flights)}
+
+    def wrap(self, name, call):
+        """
+        在调用链上加一层请求合并，只合并不带metadata的请求，等待者拿到的是响应的副本
+        :param name: 方法名
+        :param call: call(args, kwargs)
+        :return:
+        """
+
+        def coalesced(args, kwargs):
+            if kwargs.get("metadata") or len(args) != 1:
+                return call(args, kwargs)
+            key = (name, args[0].SerializeToString(deterministic=True))
+            response, leader = self.do(key, lambda: call(args, kwargs), kwargs.get("timeout"))
+            if leader:
+                return response
+            copy = type(response)()
+            copy.CopyFrom(response)
+            return copy
+
+        return coalesced
@@ -0,0 +1,81 @@
+import importlib
+
+# 除servers/host/port/weight/size/stub/intercept以外，原样传给连接池的配置项
+POOL_OPTIONS = (
+    "reconnect_loop_time", "reconnect_max_time", "reconnect_jitter",
+    "balancer", "ewma_decay",
+    "checkout_timeout", "max_waiters",
+    "cache", "coalesce", "batch", "hedge", "retry", "retry_budget",
+    "circuit_breaker", "default_timeout", "method_timeouts",
+    "metrics",
+)
+
+
+def import_string(path):
+    """
+    通过 "module.path.ClassName" 导入对象
+    :param path:
+    :return:
+    """
+    module_path, class_name = path.rsplit('.', 1)
+
+    modle = importlib.import_module(module_path)
+    return getattr(modle, class_name)
+
+
+def read_config(config):
+    """
+    读取yaml配置文件
+    :param config: 配置文件路径
+    :return:
+    """
+    import yaml
+
+    with open(config) as cfg:
+        return yaml.full_load(cfg) or {}
+
+
+def pool_kwargs(pool):
+    """
+    把配置文件中的一个连接池配置转换为ClientConnectionPool的参数
+    :param pool: 连接池配置
+    :return:
+    """
+    hosts = []
+    ports = []
+    weight = []
+    kwargs = {"pool_size": 3, "stub_cls": None, "intercept": None}
+    for k, v in pool.items():
+        if k == "servers":
+            for server in v:
+                hosts.append(server.get("host"))
+                ports.append(server.get("port"))
+                weight.append(server.get("weight"))
+        elif k == "host":
+            hosts.append(v)
+        elif k == "port":
+            ports.append(v)
+        elif k == "weight":
+            weight.append(v)
+        elif k == "size":
+            kwargs["pool_size"] = v
+        elif k == "stub":
+            if v:
+                kwargs["stub_cls"] = import_string(v)
+        elif k == "intercept":
+            if v:
+                kwargs["intercept"] = import_string(v)
+        elif k in POOL_OPTIONS:
+            kwargs[k] = v
+    kwargs.update(host=hosts, port=ports, weights=weight)
+    return kwargs
+
+
+def load_config(config):
+    """
+    读取配置文件，返回每个连接池的参数
+    :param config: 配置文件路径
+    :return: [dict, ]
+    """
+    data = read_config(config)
+    return [pool_kwargs(pool) for pool in data.get("manager") or []]
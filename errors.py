@@ -0,0 +1,55 @@
+from grpc import RpcError, StatusCode
+
+
+def status_code(error):
+    """
+    异常的grpc状态码，不是grpc的错误时返回None
+    :param error:
+    :return:
+    """
+    code = getattr(error, "code", None)
+    if isinstance(error, RpcError) and callable(code):
+        return code()
+    return None
+
+
+class ClientRpcError(RpcError):
+    """
+    客户端自己产生的错误(没有真正发出请求或请求被合并)，与grpc返回的错误一样可以通过code()判断
+    """
+    status_code = StatusCode.UNKNOWN
+
+    def __init__(self, details=None):
+        details = details or self.status_code.value[1]
+        super(ClientRpcError, self).__init__(details)
+        self._details = details
+
+    def code(self):
+        return self.status_code
+
+    def details(self):
+        return self._details
+
+    def __str__(self):
+        return "<%s: %s>" % (self.__class__.__name__, self._details)
+
+
+class DeadlineExceeded(ClientRpcError):
+    """
+    在发出请求之前或等待其他调用的结果时超时
+    """
+    status_code = StatusCode.DEADLINE_EXCEEDED
+
+
+class NotFound(ClientRpcError):
+    """
+    批量请求的响应中没有对应的条目
+    """
+    status_code = StatusCode.NOT_FOUND
+
+
+class Unavailable(ClientRpcError):
+    """
+    没有可用的连接
+    """
+    status_code = StatusCode.UNAVAILABLE
@@ -0,0 +1,193 @@
+"""
+把连接池的指标和连接状态渲染为Prometheus文本格式，并提供一个可选的HTTP端点
+
+渲染不获取请求路径上使用的任何锁: 指标在各线程的分片上合并，连接状态和权重直接读取
+"""
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import monotonic
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# (名称, 类型, 说明)，按此顺序输出
+FAMILIES = (
+    ("grpc_client_calls_total", "counter", "Completed calls by method, host and status code."),
+    ("grpc_client_call_latency_seconds", "histogram", "Call latency by method and host."),
+    ("grpc_client_inflight", "gauge", "Calls in flight by host."),
+    ("grpc_client_checkout_wait_seconds", "histogram", "Time spent waiting for a usable connection."),
+    ("grpc_client_channels", "gauge", "Channels by connectivity state."),
+    ("grpc_client_channel_state", "gauge", "Current state of each channel (always 1)."),
+    ("grpc_client_host_weight", "gauge", "Configured weight of each host."),
+    ("grpc_client_host_ejected", "gauge", "1 while the host is ejected by its circuit breaker."),
+)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(**labels):
+    return ",".join('%s="%s"' % (k, _escape(v)) for k, v in labels.items())
+
+
+def _number(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _histogram(name, labels, histogram):
+    lines = []
+    for bound, count in histogram["buckets"]:
+        lines.append('%s_bucket{%s,le="%s"} %d' % (name, labels, _number(bound), count))
+    lines.append("%s_sum{%s} %s" % (name, labels, _number(histogram["sum"])))
+    lines.append("%s_count{%s} %d" % (name, labels, histogram["count"]))
+    return lines
+
+
+class PrometheusRenderer(object):
+    """
+    渲染多个连接池的指标，结果缓存min_interval秒
+
+    每个(连接池, 方法, 地址)的文本按调用次数缓存，没有新调用的序列直接复用上次的文本
+    """
+
+    def __init__(self, min_interval=1):
+        """
+        :param min_interval: 两次渲染的最小间隔(秒)，间隔内的抓取返回缓存的结果
+        """
+        self.min_interval = min_interval
+        self._lock = threading.Lock()
+        self._text = None
+        self._rendered_at = None
+        self._series = {}
+        self.renders = 0
+        self.reused = 0
+
+    @staticmethod
+    def pool_name(pool):
+        return pool.name or "pool-%x" % id(pool)
+
+    def _call_series(self, pool_name, calls, seen):
+        families = {}
+        for (method, host), histogram in calls.items():
+            key = (pool_name, method, host)
+            seen.add(key)
+            cached = self._series.get(key)
+            if cached is not None and cached[0] == histogram["count"]:
+                self.reused += 1
+                lines = cached[1]
+            else:
+                labels = _labels(pool=pool_name, method=method, host=host)
+                lines = {
+                    "grpc_client_calls_total": ["grpc_client_calls_total{%s,code=\"%s\"} %d" % (labels, code, n)
+                                                for code, n in sorted(histogram["codes"].items())],
+                    "grpc_client_call_latency_seconds": _histogram("grpc_client_call_latency_seconds", labels,
+                                                                   histogram),
+                }
+                self._series[key] = (histogram["count"], lines)
+            for family, family_lines in lines.items():
+                families.setdefault(family, []).extend(family_lines)
+        return families
+
+    def _pool(self, pool, seen):
+        name = self.pool_name(pool)
+        families = {}
+        metrics = getattr(pool, "metrics", None)
+        if metrics is not None:
+            snapshot = metrics.snapshot()
+            families = self._call_series(name, snapshot["calls"], seen)
+            families["grpc_client_inflight"] = [
+                "grpc_client_inflight{%s} %d" % (_labels(pool=name, host=host), n)
+                for host, n in sorted(snapshot["inflight"].items())]
+            if snapshot["checkout"] is not None:
+                families["grpc_client_checkout_wait_seconds"] = _histogram(
+                    "grpc_client_checkout_wait_seconds", _labels(pool=name), snapshot["checkout"])
+
+        families["grpc_client_channels"] = [
+            "grpc_client_channels{%s} %d" % (_labels(pool=name, state=state), n)
+            for state, n in sorted(pool.count_by_state().items())]
+        families["grpc_client_channel_state"] = [
+            "grpc_client_channel_state{%s} 1" % _labels(pool=name, channel=channel.name,
+                                                        host="%s:%s" % (channel.host, channel.port),
+                                                        state=channel.state)
+            for channel in list(pool.pool)]
+        families["grpc_client_host_weight"] = [
+            "grpc_client_host_weight{%s} %s" % (_labels(pool=name, host="%s:%s" % (host, port)), _number(weight))
+            for host, port, weight in zip(pool.hosts, pool.ports, pool.weights)]
+        breakers = getattr(pool, "breakers", None)
+        if breakers is not None:
+            families["grpc_client_host_ejected"] = [
+                "grpc_client_host_ejected{%s} %d" % (_labels(pool=name, host=host), state == "OPEN")
+                for host, state in sorted(breakers.states().items())]
+        return families
+
+    def render(self, pools):
+        """
+        :param pools: 连接池列表
+        :return: Prometheus文本格式
+        """
+        with self._lock:
+            now = monotonic()
+            if self._text is not None and now - self._rendered_at < self.min_interval:
+                return self._text
+            seen = set()
+            families = {}
+            for pool in sorted(pools, key=self.pool_name):
+                for family, lines in self._pool(pool, seen).items():
+                    families.setdefault(family, []).extend(lines)
+            # 丢弃已经不存在的连接池或序列的缓存
+            for key in [key for key in self._series if key not in seen]:
+                del self._series[key]
+
+            out = []
+            for name, kind, doc in FAMILIES:
+                lines = families.get(name)
+                if not lines:
+                    continue
+                out.append("# HELP %s %s" % (name, doc))
+                out.append("# TYPE %s %s" % (name, kind))
+                out.extend(lines)
+            self._text = "\n".join(out) + "\n"
+            self._rendered_at = now
+            self.renders += 1
+            return self._text
+
+
+class MetricsHTTPServer(object):
+    """
+    在后台线程中运行的HTTP端点，GET任意路径返回render()的结果
+    """
+
+    def __init__(self, render, host="", port=9464):
+        """
+        :param render: 无参数，返回Prometheus文本
+        :param host: 监听地址
+        :param port: 监听端口，为0时随机
+        """
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                try:
+                    body = render().encode("utf-8")
+                except Exception as e:
+                    self.send_error(500, repr(e))
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", CONTENT_TYPE)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.port = self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever, name="grpc-metrics-http", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
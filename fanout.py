@@ -0,0 +1,99 @@
+from queue import Queue, Empty
+from time import monotonic
+
+from .errors import DeadlineExceeded
+
+
+class FanOutResult(object):
+    """
+    发往一个地址的请求的结果，error为None时成功
+    """
+    __slots__ = ("address", "response", "error")
+
+    def __init__(self, address, response=None, error=None):
+        self.address = address
+        self.response = response
+        self.error = error
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    def __repr__(self):
+        if self.error is None:
+            return "<%s %s ok>" % (self.__class__.__name__, self.address)
+        return "<%s %s %s>" % (self.__class__.__name__, self.address, self.error)
+
+
+class FanOut(object):
+    """
+    同时发往多个地址的请求，迭代时按完成的先后顺序返回FanOutResult
+
+    超过timeout仍未完成的请求会被取消，并以DeadlineExceeded作为结果返回
+    """
+
+    def __init__(self, timeout=None):
+        self.timeout = timeout
+        self.futures = {}
+        self.results = []
+        self._done = Queue()
+        self._pending = 0
+
+    def add(self, address, future):
+        """
+        加入一个请求
+        :param address: "host:port"
+        :param future: grpc.Future
+        :return:
+        """
+        self.futures[address] = future
+        self._pending += 1
+        future.add_done_callback(lambda f: self._done.put(self._result(address, f)))
+
+    def add_error(self, address, error):
+        """
+        加入一个没能发出的请求
+        :param address:
+        :param error:
+        :return:
+        """
+        self._pending += 1
+        self._done.put(FanOutResult(address, error=error))
+
+    @staticmethod
+    def _result(address, future):
+        try:
+            return FanOutResult(address, future.result())
+        except Exception as e:
+            return FanOutResult(address, error=e)
+
+    def __iter__(self):
+        deadline = None if self.timeout is None else monotonic() + self.timeout
+        while self._pending:
+            try:
+                result = self._done.get(timeout=None if deadline is None else max(deadline - monotonic(), 0))
+            except Empty:
+                break
+            self._pending -= 1
+            self.results.append(result)
+            yield result
+        if self._pending:
+            seen = set(r.address for r in self.results)
+            for address, future in self.futures.items():
+                if address not in seen:
+                    future.cancel()
+                    result = FanOutResult(address, error=DeadlineExceeded())
+                    self._pending -= 1
+                    self.results.append(result)
+                    yield result
+
+    def wait(self):
+        """
+        等待所有请求完成
+        :return: ({地址: 响应}, {地址: 异常})
+        """
+        for _ in self:
+            pass
+        responses = dict((r.address, r.response) for r in self.results if r.error is None)
+        errors = dict((r.address, r.error) for r in self.results if r.error is not None)
+        return responses, errors
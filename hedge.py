@@ -0,0 +1,164 @@
+from queue import Queue, Empty
+from threading import Lock
+from time import monotonic
+
+from .utils import TokenBucket
+
+
+class LatencyWindow(object):
+    """
+    最近size个请求的耗时，用于按分位数计算对冲延迟，每积累refresh个新样本重新计算一次分位数
+    """
+
+    def __init__(self, size=1000, refresh=100):
+        self.size = size
+        self.refresh = refresh
+        self._samples = []
+        self._next = 0
+        self._fresh = 0
+        self._sorted = None
+        self._lock = Lock()
+
+    def add(self, latency):
+        with self._lock:
+            if len(self._samples) < self.size:
+                self._samples.append(latency)
+            else:
+                self._samples[self._next] = latency
+                self._next = (self._next + 1) % self.size
+            self._fresh += 1
+            if self._sorted is not None and self._fresh >= self.refresh:
+                self._sorted = None
+
+    def percentile(self, p, min_samples=20):
+        """
+        :param p: 分位数，如95
+        :param min_samples: 样本数不足时返回None
+        :return:
+        """
+        with self._lock:
+            if len(self._samples) < min_samples:
+                return None
+            if self._sorted is None:
+                self._sorted = sorted(self._samples)
+                self._fresh = 0
+            values = self._sorted
+        return values[min(int(len(values) * p / 100.0), len(values) - 1)]
+
+
+class Hedger(object):
+    """
+    对冲请求: 第一次请求在delay秒内没有返回时，向另一个地址的连接再发一次，使用先成功的结果并取消另一个
+
+    对冲请求受令牌桶限制，最多占正常请求的budget比例，避免故障时放大负载
+    """
+
+    def __init__(self, pool, name, delay=None, percentile=None, min_samples=20, budget=0.1, burst=10):
+        """
+        :param pool: 连接池
+        :param name: 方法名
+        :param delay: 发出对冲请求前等待的时间(秒)，设置percentile时作为样本不足时的默认值
+        :param percentile: 按该方法最近耗时的分位数(如95)决定等待时间
+        :param min_samples: 按分位数计算前至少需要的样本数
+        :param budget: 对冲请求占正常请求的最大比例
+        :param burst: 令牌桶的上限
+        """
+        self.pool = pool
+        self.name = name
+        self.fixed_delay = delay
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.budget = TokenBucket(budget, burst)
+        self.latencies = LatencyWindow() if percentile else None
+        self.calls = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+
+    def delay(self):
+        """
+        本次请求发出对冲前等待的时间，为None时不对冲
+        :return:
+        """
+        if self.latencies is not None:
+            delay = self.latencies.percentile(self.percentile, self.min_samples)
+            if delay is not None:
+                return delay
+        return self.fixed_delay
+
+    def _send(self, channel, args, kwargs, done):
+        method = channel.stub_methods.get(self.name)
+        if method is None:
+            raise AttributeError("[%s] not defined in %s" % (self.name, channel.stub_cls))
+        future = self.pool.method_proxy_cls.invoke_future(channel, method, args, kwargs, self.name)
+        future.add_done_callback(done.put)
+        return future
+
+    def __call__(self, args, kwargs, failed=None):
+        """
+        :param args:
+        :param kwargs:
+        :param failed: 重试时已经失败的地址集合 {(host, port)}，选取连接时避开，本次失败的地址也加入其中
+        :return:
+        """
+        self.calls += 1
+        self.budget.deposit()
+        start = monotonic()
+        done = Queue()
+        first = self.pool.connection_excluding(failed) if failed else self.pool.get_one_connection()
+        channels = [first]
+        futures = [self._send(first, args, kwargs, done)]
+
+        timeout = kwargs.get("timeout")
+        delay = self.delay()
+        if delay is not None and (timeout is None or delay < timeout):
+            try:
+                done.get(timeout=delay)
+            except Empty:
+                if self.budget.withdraw():
+                    second = self.pool.other_connection(first, failed)
+                    if second is not None:
+                        if timeout is not None:
+                            kwargs = dict(kwargs, timeout=timeout - (monotonic() - start))
+                        channels.append(second)
+                        futures.append(self._send(second, args, kwargs, done))
+                        self.hedged += 1
+            else:
+                done.put(futures[0])
+
+        error = None
+        for _ in futures:
+            future = done.get()
+            try:
+                response = future.result()
+            except Exception as e:
+                error = e
+                if failed is not None:
+                    channel = channels[futures.index(future)]
+                    failed.add((channel.host, channel.port))
+                continue
+            for other in futures:
+                if other is not future:
+                    other.cancel()
+            if future is not futures[0]:
+                self.hedge_wins += 1
+            if self.latencies is not None:
+                self.latencies.add(monotonic() - start)
+            return response
+        raise error
+
+    def stats(self):
+        """
+        :return: {"calls":, "hedged":, "hedge_wins":, "delay":, "budget": {...}}
+        """
+        return {"calls": self.calls, "hedged": self.hedged, "hedge_wins": self.hedge_wins,
+                "delay": self.delay(), "budget": self.budget.stats()}
+
+
+def build_hedgers(pool, config):
+    """
+    根据配置创建每个方法的对冲
+    :param pool: 连接池
+    :param config: {方法名: {"delay": 秒, "percentile": 95, "budget": 0.1, "burst": 10}}
+    :return: {方法名: Hedger}
+    """
+    return dict((name, Hedger(pool, name, **(options or {}))) for name, options in (config or {}).items())
@@ -1,74 +1,389 @@
+import os
 import threading
-import importlib
+from itertools import count
+from random import randrange
 
-import yaml
+from .client import ClientConnectionPool, wait_ready
+from .config import POOL_OPTIONS, import_string, pool_kwargs, read_config
+from .reconnect import ReconnectScheduler
+from .utils import stub_method_paths
 
-from .client import ClientConnectionPool
+
+class MethodRouter(object):
+    """
+    同一个 "/Service/Method" 由多个连接池提供时，按策略把调用分散到各个连接池
+
+    策略:
+        round_robin: 轮询(默认)
+        random: 随机
+        least_request: 正在处理的请求数最少的连接池
+    选中的连接池没有可用连接时依次尝试其他连接池
+    """
+    policies = ("round_robin", "random", "least_request")
+
+    def __init__(self, path, policy="round_robin"):
+        if policy not in self.policies:
+            raise ValueError("unknown route policy [%s], must in %s" % (policy, list(self.policies)))
+        self.path = path
+        self.policy = policy
+        self.pools = []
+        self.dispatchers = []
+        self._counter = count()
+
+    def add(self, pool, name):
+        """
+        加入一个提供该方法的连接池
+        :param pool: 连接池
+        :param name: 方法在该连接池stub中的名称
+        :return:
+        """
+        if pool in self.pools:
+            return
+        self.pools = self.pools + [pool]
+        self.dispatchers = self.dispatchers + [pool.dispatcher(name)]
+
+    def set_policy(self, policy):
+        if policy not in self.policies:
+            raise ValueError("unknown route policy [%s], must in %s" % (policy, list(self.policies)))
+        self.policy = policy
+
+    def remove(self, pool):
+        """
+        移除一个连接池
+        :param pool:
+        :return:
+        """
+        if pool not in self.pools:
+            return
+        i = self.pools.index(pool)
+        self.pools = self.pools[:i] + self.pools[i + 1:]
+        self.dispatchers = self.dispatchers[:i] + self.dispatchers[i + 1:]
+
+    def target(self):
+        """
+        只有一个连接池时直接返回它的调度器，省去一层转发
+        :return:
+        """
+        if len(self.dispatchers) == 1:
+            return self.dispatchers[0]
+        return self
+
+    def _order(self):
+        dispatchers = self.dispatchers
+        n = len(dispatchers)
+        if n < 2:
+            return dispatchers
+        if self.policy == "round_robin":
+            i = next(self._counter) % n
+        elif self.policy == "random":
+            i = randrange(n)
+        else:
+            loads = [sum(c.inflight for c in d.pool.pool) for d in dispatchers]
+            i = loads.index(min(loads))
+        return dispatchers[i:] + dispatchers[:i]
+
+    def _route(self, attr, args, kwargs):
+        error = None
+        for dispatcher in self._order():
+            try:
+                method = dispatcher if attr is None else getattr(dispatcher, attr)
+                return method(*args, **kwargs)
+            except BlockingIOError as e:
+                error = e
+        if error is None:
+            raise AttributeError("[%s] has no pool" % self.path)
+        raise error
+
+    def __call__(self, *args, **kwargs):
+        return self._route(None, args, kwargs)
+
+    def with_call(self, *args, **kwargs):
+        return self._route("with_call", args, kwargs)
+
+    def future(self, *args, **kwargs):
+        return self._route("future", args, kwargs)
+
+    def __repr__(self):
+        return "<%s %s %s pools=%d>" % (self.__class__.__name__, self.path, self.policy, len(self.pools))
 
 
 class Manager(object):
     _instance_lock = threading.Lock()
     _instance = None
 
+    # 方法名 -> MethodRouter
     methods = {}
+    # "/Service/Method" -> MethodRouter
+    routes = {}
+    # 多个不同的服务中存在的同名方法，只能通过完整路径调用
+    ambiguous_methods = set()
     pools = set()
 
+    pool_cls = ClientConnectionPool
+    route_policy = "round_robin"
+    # 配置文件中warm_up为true时，是否在__init__中预热
+    warm_up_on_init = True
+
     def __new__(cls, *args, **kwargs):
-        if not getattr(Manager, "_instance"):
-            with Manager._instance_lock:
-                if not getattr(Manager, "_instance"):
-                    Manager._instance = object.__new__(cls)
-        return Manager._instance
+        # 每个子类各自单例
+        if not cls.__dict__.get("_instance"):
+            with cls._instance_lock:
+                if not cls.__dict__.get("_instance"):
+                    cls._instance = object.__new__(cls)
+        return cls._instance
 
     def __init__(self, config=None, *args, **kwargs):
+        """
+        :param config: 配置文件路径
+        :param route_policy: 多个连接池提供同一个方法时的路由策略，round_robin/random/least_request
+        :param lazy: 延迟模式，第一次调用某个方法时才导入对应的stub模块并创建连接池，默认取配置文件中的lazy
+        """
+        if getattr(self, "reconnect_scheduler", None) is None:
+            # 该Manager下所有连接池共用一个后台重连线程
+            self.reconnect_scheduler = ReconnectScheduler("grpc-reconnect-manager")
+        if kwargs.get("route_policy"):
+            self.route_policy = kwargs["route_policy"]
+
+        if getattr(self, "config_pools", None) is None:
+            # 配置文件中的连接池，key为配置中的name，没有name时为 "stub路径#序号"
+            self.config_pools = {}
+            self.config = None
+            self._watcher = None
+            # 延迟模式下尚未创建的连接池配置
+            self.lazy = False
+            self.pending_pools = {}
+            self._pending_stubs = {}
+            self._resolve_lock = threading.Lock()
 
         if config:
-            with open(config) as cfg:
-                data = yaml.full_load(cfg)
-
-            manager = data.get("manager")
-
-            for pool in manager:
-                hosts = []
-                ports = []
-                weight = []
-                size = 3
-                stub = None
-                intercept = None
-                for k, v in pool.items():
-                    if k == "servers":
-                        for server in v:
-                            host = server.get("host")
-                            hosts.append(host)
-                            port = server.get("port")
-                            ports.append(port)
-                            weight_ = server.get("weight")
-                            weight.append(weight_)
-                    if k == "host":
-                        hosts.append(v)
-                    elif k == "port":
-                        ports.append(v)
-                    elif k == "weight":
-                        weight.append(v)
-                    elif k == "size":
-                        size = v
-                    elif k == "stub":
-                        if v:
-                            module_path, class_name = v.rsplit('.', 1)
-
-                            modle = importlib.import_module(module_path)
-                            meth = getattr(modle, class_name)
-                            stub = meth
-                    elif k == "intercept":
-
-                        if v:
-                            module_path, class_name = v.rsplit('.', 1)
-
-                            modle = importlib.import_module(module_path)
-                            meth = getattr(modle, class_name)
-                            intercept = meth
-                p = ClientConnectionPool(host=hosts, port=ports, pool_size=size, stub_cls=stub, intercept=intercept)
-                self.register(p)
+            self.config = config
+            data = read_config(config)
+            if data.get("route_policy"):
+                self.route_policy = data["route_policy"]
+            self.lazy = kwargs.get("lazy", data.get("lazy", False))
+            for key, pool in self._pool_specs(data):
+                if self.lazy:
+                    self.pending_pools[key] = pool
+                else:
+                    self._build_pool(key, pool)
+            if data.get("warm_up") and self.warm_up_on_init:
+                self.warm_up_result = self.warm_up(data.get("warm_up_timeout", 5))
+            if data.get("metrics_port") is not None:
+                self.start_metrics_server(data["metrics_port"], data.get("metrics_host", ""))
+
+    def _build_pool(self, key, spec, kwargs=None):
+        """
+        按配置创建并注册连接池
+        :param key: 连接池的key
+        :param spec: 连接池配置
+        :param kwargs: 已经解析好的连接池参数
+        :return:
+        """
+        p = self.pool_cls(reconnect_scheduler=self.reconnect_scheduler, **(kwargs or pool_kwargs(spec)))
+        p.name = key
+        self.config_pools[key] = p
+        self.register(p)
+        return p
+
+    def _serves(self, key, spec, item):
+        """
+        尚未创建的连接池是否提供某个方法，配置中有methods时不导入stub模块
+        :param key: 连接池的key
+        :param spec: 连接池配置
+        :param item: 方法名或完整路径
+        :return:
+        """
+        methods = spec.get("methods")
+        if methods:
+            return item in methods
+        if not spec.get("stub"):
+            return False
+        stub_cls = self._pending_stubs.get(key)
+        if stub_cls is None:
+            stub_cls = import_string(spec["stub"])
+            self._pending_stubs[key] = stub_cls
+        paths = stub_method_paths(stub_cls)
+        return item in paths or item in paths.values()
+
+    def _resolve(self, item):
+        """
+        创建所有提供某个方法的待创建连接池
+        :param item: 方法名或完整路径
+        :return: 是否创建了连接池
+        """
+        with self._resolve_lock:
+            built = False
+            for key, spec in list(self.pending_pools.items()):
+                if self._serves(key, spec, item):
+                    self.pending_pools.pop(key)
+                    self._pending_stubs.pop(key, None)
+                    self._build_pool(key, spec)
+                    built = True
+            return built
+
+    def warm_up(self, timeout=5):
+        """
+        同时建立所有连接池的所有连接，共用一个截止时间
+        :param timeout: 最长等待时间(秒)
+        :return: {"host:port": {"ready": 已连接数, "total": 连接数}}
+        """
+        channels = []
+        for pool in list(self.pools):
+            channels.extend(pool.pool)
+        return wait_ready(channels, timeout)
+
+    @staticmethod
+    def _pool_specs(data):
+        """
+        给配置文件中的每个连接池一个稳定的key，用于重新加载时对比
+        :param data: 配置
+        :return: [(key, 连接池配置), ]
+        """
+        specs = []
+        seen = {}
+        for pool in data.get("manager") or []:
+            key = pool.get("name")
+            if not key:
+                stub = pool.get("stub") or ""
+                seen[stub] = seen.get(stub, -1) + 1
+                key = "%s#%d" % (stub, seen[stub])
+            specs.append((key, pool))
+        return specs
+
+    def reload(self, config=None, drain_timeout=30):
+        """
+        重新加载配置文件，与现有连接池对比后增量修改:
+        新增的连接池建立连接，删除的连接池等请求结束后关闭，
+        服务端列表、权重和连接数的变化交给ClientConnectionPool.update，
+        stub、拦截器或其他选项变化时重建该连接池
+        :param config: 配置文件路径，默认为上次加载的文件
+        :param drain_timeout: 等待被删除连接上的请求结束的最长时间(秒)
+        :return: {"added": [key], "removed": [key], "updated": [key], "replaced": [key]}
+        """
+        config = config or self.config
+        if not config:
+            raise ValueError("no config to reload")
+        self.config = config
+        data = read_config(config)
+        policy = data.get("route_policy") or self.route_policy
+        if policy != self.route_policy:
+            self.route_policy = policy
+            for router in list(self.routes.values()):
+                router.set_policy(policy)
+
+        result = {"added": [], "removed": [], "updated": [], "replaced": []}
+        specs = self._pool_specs(data)
+        keys = set(key for key, _ in specs)
+        for key in list(self.pending_pools):
+            if key not in keys:
+                self.pending_pools.pop(key)
+                self._pending_stubs.pop(key, None)
+                result["removed"].append(key)
+        for key in list(self.config_pools):
+            if key not in keys:
+                pool = self.config_pools.pop(key)
+                self.unregister(pool)
+                pool.update(host=[], port=[], weights=[], pool_size=0, drain_timeout=drain_timeout)
+                result["removed"].append(key)
+
+        for key, spec in specs:
+            pool = self.config_pools.get(key)
+            if pool is None and (self.lazy or key in self.pending_pools):
+                if key not in self.pending_pools:
+                    result["added"].append(key)
+                elif self.pending_pools[key] != spec:
+                    result["updated"].append(key)
+                self.pending_pools[key] = spec
+                self._pending_stubs.pop(key, None)
+                continue
+            kwargs = pool_kwargs(spec)
+            if pool is not None and self._same_options(pool, kwargs):
+                changes = pool.update(host=kwargs["host"], port=kwargs["port"], weights=kwargs["weights"],
+                                      pool_size=kwargs["pool_size"], drain_timeout=drain_timeout)
+                if any(changes.values()):
+                    result["updated"].append(key)
+                continue
+            self._build_pool(key, spec, kwargs)
+            if pool is None:
+                result["added"].append(key)
+            else:
+                self.unregister(pool)
+                pool.update(host=[], port=[], weights=[], pool_size=0, drain_timeout=drain_timeout)
+                result["replaced"].append(key)
+        return result
+
+    @staticmethod
+    def _same_options(pool, kwargs):
+        """
+        除服务端列表、权重和连接数以外的配置是否相同
+        """
+        if pool.stub_cls is not kwargs.get("stub_cls") or pool.intercept is not kwargs.get("intercept"):
+            return False
+        return pool.options == dict((k, kwargs[k]) for k in POOL_OPTIONS if k in kwargs)
+
+    def watch_config(self, interval=2):
+        """
+        启动后台线程，配置文件修改后自动重新加载
+        :param interval: 检查文件修改时间的间隔(秒)
+        :return:
+        """
+        if not self.config:
+            raise ValueError("no config to watch")
+        if self._watcher is not None:
+            return
+        stop = threading.Event()
+
+        def watch():
+            mtime = os.stat(self.config).st_mtime
+            while not stop.wait(interval):
+                try:
+                    current = os.stat(self.config).st_mtime
+                    if current != mtime:
+                        mtime = current
+                        print("[Manager] reload %s: %s" % (self.config, self.reload()))
+                except Exception as e:
+                    print("[Manager] reload %s failed: %r" % (self.config, e))
+
+        thread = threading.Thread(target=watch, name="grpc-config-watcher", daemon=True)
+        self._watcher = (thread, stop)
+        thread.start()
+
+    def stop_watch_config(self):
+        if self._watcher is not None:
+            self._watcher[1].set()
+            self._watcher = None
+
+    def render_metrics(self, min_interval=1):
+        """
+        把所有连接池的指标、连接状态和权重渲染为Prometheus文本格式，min_interval秒内重复调用返回缓存
+        :param min_interval: 两次渲染的最小间隔(秒)
+        :return:
+        """
+        from .exposition import PrometheusRenderer
+
+        renderer = self.__dict__.get("_renderer")
+        if renderer is None:
+            renderer = self.__dict__["_renderer"] = PrometheusRenderer(min_interval)
+        return renderer.render(list(self.pools))
+
+    def start_metrics_server(self, port=9464, host=""):
+        """
+        在后台线程中启动Prometheus抓取端点，配置文件顶层的metrics_port也会启动它
+        :param port: 端口，为0时随机
+        :param host: 监听地址
+        :return: MetricsHTTPServer，端口为其port属性
+        """
+        from .exposition import MetricsHTTPServer
+
+        server = self.__dict__.get("_metrics_server")
+        if server is None:
+            server = self.__dict__["_metrics_server"] = MetricsHTTPServer(self.render_metrics, host, port)
+        return server
+
+    def stop_metrics_server(self):
+        server = self.__dict__.pop("_metrics_server", None)
+        if server is not None:
+            server.stop()
 
     def register(self, *args):
         """
@@ -80,19 +395,73 @@ class Manager(object):
             self.pools.add(pool)
             self._collect_methods(pool)
 
+    def unregister(self, *args):
+        """
+        注销连接池，不关闭连接
+        :param args: [class:ClientConnectionPool,]
+        :return:
+        """
+        for pool in args:
+            self.pools.discard(pool)
+            for path, router in list(self.routes.items()):
+                if pool not in router.pools:
+                    continue
+                router.remove(pool)
+                if not router.pools:
+                    del self.routes[path]
+                for name, alias in list(self.methods.items()):
+                    if alias is router:
+                        if router.pools:
+                            if not hasattr(type(self), name):
+                                self.__dict__[name] = router.target()
+                        else:
+                            self.methods.pop(name)
+                            self.__dict__.pop(name, None)
+
     def _collect_methods(self, pool):
         """
-        注册所有连接池的方法
+        注册连接池的所有方法，按完整路径路由，方法名作为别名，同时把调度器缓存在实例属性上
         :return:
         """
-        for method in pool.methods:
-            self.methods[method] = pool
+        for name in pool.methods:
+            path = pool.method_paths.get(name) or name
+            router = self.routes.get(path)
+            if router is None:
+                router = MethodRouter(path, self.route_policy)
+                self.routes[path] = router
+            router.add(pool, name)
 
-    def __getattr__(self, item):
-        if item in self.methods:
-            method = getattr(self.methods[item], item, None)
-            if not method:
-                raise AttributeError("[%s] not defined in %s" % (item, self.__class__))
-            return method
-        else:
+            if name in self.ambiguous_methods:
+                continue
+            alias = self.methods.get(name)
+            if alias is not None and alias is not router:
+                # 不同服务的同名方法，别名失效
+                self.ambiguous_methods.add(name)
+                self.methods.pop(name)
+                self.__dict__.pop(name, None)
+                continue
+            self.methods[name] = router
+            # 不覆盖Manager自身的属性和方法
+            if not hasattr(type(self), name):
+                self.__dict__[name] = router.target()
+
+    def get_method(self, item):
+        """
+        通过完整路径 "/Service/Method" 或方法名获取可调用对象
+        :param item:
+        :return:
+        """
+        router = self.routes.get(item) or self.methods.get(item)
+        if router is None and self.__dict__.get("pending_pools") and self._resolve(item):
+            router = self.routes.get(item) or self.methods.get(item)
+        if router is None:
+            if item in self.ambiguous_methods:
+                raise AttributeError("[%s] is defined in several services, call it by full path" % item)
             raise AttributeError("[%s] not defined in %s" % (item, self.__class__))
+        return router.target()
+
+    def __getattr__(self, item):
+        # grpc方法名以字母开头，"_"开头的名称(如copy、pickle探测的__deepcopy__)不是方法，不导入延迟模式的stub模块
+        if item.startswith("_"):
+            raise AttributeError("%r object has no attribute %r" % (self.__class__.__name__, item))
+        return self.get_method(item)
@@ -0,0 +1,182 @@
+"""
+连接池的调用指标: 每个方法和地址的延迟直方图、按状态码的请求数、正在处理的请求数和等待连接的时间
+
+写入时只修改当前线程自己的分片，不加锁；读取时合并所有线程的分片
+"""
+import threading
+import weakref
+from bisect import bisect_left
+
+# 延迟直方图的桶上限(秒)
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# 每个连接池只有一个等待连接时间的直方图，用固定的key
+CHECKOUT_KEY = "checkout"
+
+
+class _Series(object):
+    __slots__ = ("buckets", "sum", "count", "codes")
+
+    def __init__(self, n):
+        # 最后一个桶是+Inf
+        self.buckets = [0] * (n + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.codes = {}
+
+
+class Histograms(object):
+    """
+    按key分组的固定桶直方图，每个线程写自己的分片
+
+    线程结束后它的分片在下次collect时合并到retired中，分片数不会随线程的创建无限增长
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.bounds = tuple(buckets)
+        self._local = threading.local()
+        self._shards = []
+        self._retired = {}
+        self._lock = threading.Lock()
+
+    def _shard(self):
+        shard = {}
+        self._local.shard = shard
+        with self._lock:
+            self._shards.append((weakref.ref(threading.current_thread()), shard))
+        return shard
+
+    def observe(self, key, value, code=None):
+        """
+        记录一个值
+        :param key: 分组
+        :param value: 值，如延迟(秒)
+        :param code: 状态码名称，为None时不计数
+        :return:
+        """
+        try:
+            shard = self._local.shard
+        except AttributeError:
+            shard = self._shard()
+        series = shard.get(key)
+        if series is None:
+            series = shard[key] = _Series(len(self.bounds))
+        series.buckets[bisect_left(self.bounds, value)] += 1
+        series.sum += value
+        series.count += 1
+        if code is not None:
+            series.codes[code] = series.codes.get(code, 0) + 1
+
+    @staticmethod
+    def _merge(into, shard, size):
+        for key, series in list(shard.items()):
+            merged = into.get(key)
+            if merged is None:
+                merged = into[key] = _Series(size)
+            for i, n in enumerate(list(series.buckets)):
+                merged.buckets[i] += n
+            merged.sum += series.sum
+            merged.count += series.count
+            for code, n in list(series.codes.items()):
+                merged.codes[code] = merged.codes.get(code, 0) + n
+
+    def collect(self):
+        """
+        合并所有线程的分片
+        :return: {key: {"buckets": [(上限, 累计数), ...], "sum":, "count":, "codes": {状态码: 数量}}}
+        """
+        size = len(self.bounds)
+        with self._lock:
+            alive = []
+            for ref, shard in self._shards:
+                thread = ref()
+                if thread is None or not thread.is_alive():
+                    self._merge(self._retired, shard, size)
+                else:
+                    alive.append((ref, shard))
+            self._shards = alive
+            merged = {}
+            self._merge(merged, self._retired, size)
+        for ref, shard in alive:
+            self._merge(merged, shard, size)
+
+        result = {}
+        bounds = self.bounds + (float("inf"),)
+        for key, series in merged.items():
+            total = 0
+            cumulative = []
+            for bound, n in zip(bounds, series.buckets):
+                total += n
+                cumulative.append((bound, total))
+            result[key] = {"buckets": cumulative, "sum": series.sum, "count": series.count,
+                           "codes": dict(series.codes)}
+        return result
+
+
+class PoolMetrics(object):
+    """
+    一个连接池的指标，调用的延迟和状态码由MethodProxy在释放连接时记录(见ExtendChannel.release)
+    """
+
+    def __init__(self, pool, buckets=None):
+        """
+        :param pool: 连接池
+        :param buckets: 延迟直方图的桶上限(秒)
+        """
+        self.pool = pool
+        self.calls = Histograms(buckets or DEFAULT_BUCKETS)
+        self.checkout = Histograms(buckets or DEFAULT_BUCKETS)
+
+    def observe_call(self, name, channel, latency, code):
+        """
+        记录一次调用
+        :param name: 方法名
+        :param channel: 发送请求的连接
+        :param latency: 秒
+        :param code: grpc状态码，非grpc错误时为None
+        :return:
+        """
+        key = channel.metric_keys.get(name)
+        if key is None:
+            key = channel.metric_keys[name] = (self.pool.method_paths.get(name, name),
+                                               "%s:%s" % (channel.host, channel.port))
+        # StatusCode.name是动态属性，_name_是普通的实例属性
+        self.calls.observe(key, latency, code._name_ if code is not None else "UNKNOWN")
+
+    def observe_checkout(self, wait):
+        """
+        记录一次取连接等待的时间，包括不需要等待(0秒)和没有等到连接的取连接
+        :param wait: 秒
+        :return:
+        """
+        self.checkout.observe(CHECKOUT_KEY, wait)
+
+    def inflight(self):
+        """
+        每个地址正在处理的请求数
+        :return: {"host:port": 数量}
+        """
+        result = {}
+        for channel in list(self.pool.pool):
+            address = "%s:%s" % (channel.host, channel.port)
+            result[address] = result.get(address, 0) + channel.inflight
+        return result
+
+    def snapshot(self):
+        """
+        :return: {"calls": {(方法路径, "host:port"): 直方图}, "checkout": 直方图或None, "inflight": {"host:port": 数量}}
+        """
+        return {"calls": self.calls.collect(), "checkout": self.checkout.collect().get(CHECKOUT_KEY),
+                "inflight": self.inflight()}
+
+
+def build_metrics(pool, config, metrics_cls=PoolMetrics):
+    """
+    根据配置创建连接池的指标
+    :param pool:
+    :param config: True 或 {"buckets": [秒, ...]}，为空时不启用
+    :param metrics_cls:
+    :return: PoolMetrics 或 None
+    """
+    if not config:
+        return None
+    return metrics_cls(pool, **(config if isinstance(config, dict) else {}))
@@ -0,0 +1,118 @@
+import heapq
+import threading
+import time
+from itertools import count
+from random import uniform
+
+
+def backoff_delay(attempt, base=1, cap=60, jitter=0.5):
+    """
+    带上限和抖动的指数退避时间
+    :param attempt: 第几次重试，从0开始
+    :param base: 初始等待时间(秒)
+    :param cap: 最大等待时间(秒)
+    :param jitter: 抖动比例，0为不抖动，1为在[0, delay]中均匀分布
+    :return:
+    """
+    delay = min(cap, base * (2 ** min(attempt, 32)))
+    return uniform(delay * (1 - jitter), delay)
+
+
+class ReconnectScheduler(object):
+    """
+    后台重连调度器，用一个小顶堆加一个线程在回调之外重建连接
+    """
+
+    def __init__(self, name="grpc-reconnect"):
+        self.name = name
+        self._heap = []
+        self._seq = count()
+        self._cond = threading.Condition()
+        self._thread = None
+        self._stopped = False
+
+    def schedule(self, channel, delay):
+        """
+        delay秒后重连channel，同一个channel在重连完成前只会排队一次
+        :param channel: ExtendChannel
+        :param delay: 等待时间(秒)
+        :return: 是否加入了队列
+        """
+        with self._cond:
+            if self._stopped or channel.reconnect_pending:
+                return False
+            channel.reconnect_pending = True
+            heapq.heappush(self._heap, (time.monotonic() + delay, next(self._seq), channel))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+                self._thread.start()
+            self._cond.notify()
+        return True
+
+    def cancel(self, channel):
+        """
+        取消一个channel尚未执行的重连
+        :param channel:
+        :return:
+        """
+        with self._cond:
+            heap = [item for item in self._heap if item[2] is not channel]
+            if len(heap) != len(self._heap):
+                heapq.heapify(heap)
+                self._heap = heap
+                channel.reconnect_pending = False
+
+    def stop(self):
+        """
+        停止调度线程，未执行的重连全部丢弃
+        :return:
+        """
+        with self._cond:
+            self._stopped = True
+            for _, _, channel in self._heap:
+                channel.reconnect_pending = False
+            self._heap = []
+            self._cond.notify()
+
+    def pending(self):
+        with self._cond:
+            return len(self._heap)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._stopped:
+                    if self._heap:
+                        timeout = self._heap[0][0] - time.monotonic()
+                        if timeout <= 0:
+                            break
+                    else:
+                        timeout = None
+                    self._cond.wait(timeout)
+                if self._stopped:
+                    self._thread = None
+                    return
+                _, _, channel = heapq.heappop(self._heap)
+                channel.reconnect_pending = False
+
+            try:
+                channel.reconnect()
+            except Exception:
+                channel.schedule_reconnect()
+
+
+_default_scheduler = None
+_default_scheduler_lock = threading.Lock()
+
+
+def default_scheduler():
+    """
+    不属于任何Manager的连接池共用的调度器
+    :return:
+    """
+    global _default_scheduler
+    if _default_scheduler is None:
+        with _default_scheduler_lock:
+            if _default_scheduler is None:
+                _default_scheduler = ReconnectScheduler()
+    return _default_scheduler
@@ -0,0 +1,119 @@
+from time import monotonic, sleep
+
+from grpc import RpcError, StatusCode
+
+from .reconnect import backoff_delay
+from .utils import TokenBucket
+
+
+class RetryPolicy(object):
+    """
+    一个方法的重试策略
+    """
+
+    def __init__(self, codes=("UNAVAILABLE",), max_attempts=3, backoff=0.05, max_backoff=1, jitter=1):
+        """
+        :param codes: 可重试的状态码名称，如 ["UNAVAILABLE", "RESOURCE_EXHAUSTED"]
+        :param max_attempts: 包括第一次在内的最多请求次数
+        :param backoff: 第一次重试前的等待时间(秒)，之后每次翻倍
+        :param max_backoff: 最长等待时间(秒)
+        :param jitter: 抖动比例，1为在[0, 等待时间]中均匀分布
+        """
+        self.codes = frozenset(getattr(StatusCode, code.upper()) for code in codes)
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+
+    def retryable(self, error):
+        return isinstance(error, RpcError) and callable(getattr(error, "code", None)) and error.code() in self.codes
+
+
+class Retrier(object):
+    """
+    按重试策略重试失败的请求，每次重试优先选取还没有失败过的地址的连接
+
+    重试受连接池共用的令牌桶限制，最多占正常请求的一定比例，避免局部故障变成重试风暴
+    """
+
+    def __init__(self, pool, name, policy, budget, call=None):
+        """
+        :param pool: 连接池
+        :param name: 方法名
+        :param policy: RetryPolicy
+        :param budget: TokenBucket
+        :param call: 每次请求使用的调用(如对冲)，为None时由重试自己选取连接发送
+        """
+        self.pool = pool
+        self.name = name
+        self.policy = policy
+        self.budget = budget
+        self.call = call
+        self.retries = 0
+        self.exhausted = 0
+        self.throttled = 0
+
+    def _send(self, channel, args, kwargs):
+        method = channel.stub_methods.get(self.name)
+        if method is None:
+            raise AttributeError("[%s] not defined in %s" % (self.name, channel.stub_cls))
+        return self.pool.method_proxy_cls.invoke(channel, method, args, kwargs, self.name)
+
+    def __call__(self, args, kwargs):
+        policy = self.policy
+        self.budget.deposit()
+        timeout = kwargs.get("timeout")
+        deadline = None if timeout is None else monotonic() + timeout
+        # 已经失败的地址 {(host, port)}，对冲的调用也会把失败的地址加入其中
+        failed = set()
+        attempt = 1
+        while True:
+            channel = None
+            try:
+                if self.call is not None:
+                    return self.call(args, kwargs, failed)
+                channel = self.pool.connection_excluding(failed)
+                return self._send(channel, args, kwargs)
+            except Exception as e:
+                if channel is not None:
+                    failed.add((channel.host, channel.port))
+                if not policy.retryable(e):
+                    raise
+                if attempt >= policy.max_attempts:
+                    self.exhausted += 1
+                    raise
+                delay = backoff_delay(attempt - 1, policy.backoff, policy.max_backoff, policy.jitter)
+                if deadline is not None:
+                    remaining = deadline - monotonic() - delay
+                    if remaining <= 0:
+                        raise
+                    kwargs = dict(kwargs, timeout=remaining)
+                if not self.budget.withdraw():
+                    self.throttled += 1
+                    raise
+            self.retries += 1
+            attempt += 1
+            sleep(delay)
+
+    def stats(self):
+        """
+        :return: {"retries":, "exhausted":, "throttled":}
+        """
+        return {"retries": self.retries, "exhausted": self.exhausted, "throttled": self.throttled}
+
+
+def build_retriers(pool, config, budget=None, calls=None):
+    """
+    根据配置创建每个方法的重试
+    :param pool: 连接池
+    :param config: {方法名: {"codes": [...], "max_attempts": 3, "backoff": 0.05, "max_backoff": 1}}
+    :param budget: 连接池的重试预算 {"ratio": 0.1, "max_tokens": 10}
+    :param calls: {方法名: 每次请求使用的调用}
+    :return: ({方法名: Retrier}, TokenBucket)
+    """
+    bucket = TokenBucket(**(budget or {}))
+    calls = calls or {}
+    retriers = {}
+    for name, options in (config or {}).items():
+        retriers[name] = Retrier(pool, name, RetryPolicy(**(options or {})), bucket, calls.get(name))
+    return retriers, bucket
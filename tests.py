@@ -1,14 +1,509 @@
-from client import ClientConnectionPool
-from protogen.company_pb2_grpc import CompanyServerStub
-from manager import Manager
+"""
+不连网的单元测试(连接池使用benchmarks._offline中的假channel)，在包的上级目录中运行
 
-pool = ClientConnectionPool(stub_cls=CompanyServerStub)
+    python -m pytest grpc_client_pool/tests.py
 
-manager = Manager(config="config.yaml")
-print(manager.methods)
-print(manager.pools)
-from google.protobuf.empty_pb2 import Empty
+直接运行时连接config.yaml中的服务
 
-for i in range(10):
-    r = manager.GetAllCompany(Empty())
-    # print(r)
+    python -m grpc_client_pool.tests
+"""
+import asyncio
+import os
+import tempfile
+import time
+import unittest
+from contextlib import ExitStack
+from threading import Event, Thread
+
+from google.protobuf.wrappers_pb2 import Int32Value
+from grpc import StatusCode
+
+from .aio import AsyncClientConnectionPool
+from .benchmarks._offline import BenchManager, OfflinePool, offline_pool
+from .batch import MicroBatcher, _Batch, _Slot
+from .benchmarks._server import company_pb2, company_pb2_grpc
+from .client import ClientConnectionPool
+from .coalesce import SingleFlight
+from .errors import DeadlineExceeded, NotFound, Unavailable
+from .manager import Manager
+
+CompanyServerStub = company_pb2_grpc.CompanyServerStub
+
+
+def pick_many(pool, n=500):
+    return [pool.get_one_connection() for _ in range(n)]
+
+
+class SelectorTest(unittest.TestCase):
+
+    def test_busy_channel_not_picked(self):
+        pool = offline_pool(pool_size=4, hosts=2, stub_cls=CompanyServerStub)
+        channel = pool.get_one_connection()
+        with channel.use():
+            self.assertEqual(channel.state, "BUSY")
+            self.assertNotIn(channel, pick_many(pool))
+        self.assertIn(channel, pick_many(pool))
+
+    def test_all_busy_raises(self):
+        pool = offline_pool(pool_size=3, hosts=1, stub_cls=CompanyServerStub)
+        with ExitStack() as stack:
+            for channel in list(pool.pool):
+                stack.enter_context(channel.use())
+            self.assertRaises(BlockingIOError, pool.get_one_connection)
+        pool.get_one_connection()
+
+    def test_use_keeps_failure_state(self):
+        pool = offline_pool(pool_size=2, hosts=1, stub_cls=CompanyServerStub)
+        channel = pool.get_one_connection()
+        with channel.use():
+            channel._set_state("TRANSIENT_FAILURE")
+        self.assertEqual(channel.state, "TRANSIENT_FAILURE")
+        self.assertNotIn(channel, pick_many(pool))
+
+    def test_use_waits_for_inflight(self):
+        pool = offline_pool(pool_size=2, hosts=1, stub_cls=CompanyServerStub)
+        channel = pool.get_one_connection()
+        with channel.use():
+            channel.acquire()
+        self.assertEqual(channel.state, "BUSY")
+        channel.release()
+        self.assertEqual(channel.state, "IDLE")
+        self.assertIn(channel, pick_many(pool))
+
+    def test_use_does_not_rebuild(self):
+        pool = offline_pool(pool_size=4, hosts=2, stub_cls=CompanyServerStub)
+        pool.get_one_connection()
+        rebuilds = []
+        rebuild = pool.balancer.rebuild
+        pool.balancer.rebuild = lambda channels: (rebuilds.append(1), rebuild(channels))
+        for _ in range(20):
+            with pool.get_one_connection().use():
+                pass
+        self.assertEqual(rebuilds, [])
+
+    def test_pick_waits_for_rebuild_in_progress(self):
+        pool = offline_pool(pool_size=2, hosts=1, stub_cls=CompanyServerStub)
+        pool.get_one_connection()
+        picked = []
+        with pool._lock:
+            # 另一个线程已经清除脏标记，正在重建
+            pool._selector_dirty = False
+            pool.balancer.rebuild([])
+            thread = Thread(target=lambda: picked.append(pool.get_one_connection()))
+            thread.start()
+            time.sleep(0.05)
+            pool.balancer.rebuild(list(pool.pool))
+        thread.join(5)
+        self.assertEqual(len(picked), 1)
+
+    def test_ejected_host_not_picked(self):
+        pool = offline_pool(pool_size=4, hosts=2, stub_cls=CompanyServerStub,
+                            circuit_breaker={"consecutive_failures": 1, "base_ejection": 60})
+        channel = pool.get_one_connection()
+        channel.acquire()
+        channel.release(0.01, False, StatusCode.UNAVAILABLE)
+        self.assertEqual(pool.get_breaker_state()["%s:%s" % (channel.host, channel.port)]["state"], "OPEN")
+        self.assertEqual(set(c.port for c in pick_many(pool)), {c.port for c in pool.pool} - {channel.port})
+
+
+class BreakerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = offline_pool(pool_size=4, hosts=2, stub_cls=CompanyServerStub,
+                                 circuit_breaker={"consecutive_failures": 2, "base_ejection": 0.05,
+                                                  "half_open_requests": 1})
+        self.breakers = self.pool.breakers
+        self.channel = [c for c in self.pool.pool if c.port == 9100][0]
+
+    def finish(self, channel, code):
+        channel.acquire()
+        channel.release(0.01, code is StatusCode.OK, code)
+
+    def state(self):
+        return self.breakers.states()["127.0.0.1:9100"]
+
+    def half_open(self):
+        for _ in range(2):
+            self.finish(self.channel, StatusCode.UNAVAILABLE)
+        self.assertEqual(self.state(), "OPEN")
+        time.sleep(0.06)
+        self.assertTrue(self.breakers.check())
+        self.assertEqual(self.state(), "HALF_OPEN")
+
+    def test_not_found_does_not_eject(self):
+        for _ in range(5):
+            self.finish(self.channel, StatusCode.NOT_FOUND)
+        self.assertEqual(self.state(), "CLOSED")
+
+    def test_probe_success_closes(self):
+        self.half_open()
+        self.assertTrue(self.breakers.admit(self.channel))
+        self.assertFalse(self.breakers.admit(self.channel))
+        self.finish(self.channel, StatusCode.OK)
+        self.assertEqual(self.state(), "CLOSED")
+        self.assertEqual(self.breakers.half_open, 0)
+
+    def test_probe_failure_reopens(self):
+        self.half_open()
+        self.assertTrue(self.breakers.admit(self.channel))
+        self.finish(self.channel, StatusCode.UNAVAILABLE)
+        self.assertEqual(self.state(), "OPEN")
+        self.assertEqual(self.pool.get_breaker_state()["127.0.0.1:9100"]["ejections"], 2)
+
+    def test_release_without_probe_keeps_slot(self):
+        self.half_open()
+        self.assertTrue(self.breakers.admit(self.channel))
+        other = [c for c in self.pool.pool if c.port == 9100 and c is not self.channel][0]
+        with other.use():
+            pass
+        self.assertFalse(self.breakers.admit(self.channel))
+        self.channel.acquire()
+        self.channel.release()
+        self.assertTrue(self.breakers.admit(self.channel))
+
+
+class HostShareTest(unittest.TestCase):
+
+    def assert_shares(self, pool_size, weights, n=30000):
+        pool = offline_pool(pool_size=pool_size, hosts=len(weights), weights=weights, stub_cls=CompanyServerStub)
+        counts = {}
+        for channel in pick_many(pool, n):
+            counts[channel.port] = counts.get(channel.port, 0) + 1
+        for i, weight in enumerate(weights):
+            self.assertAlmostEqual(counts.get(9100 + i, 0) / n, weight / sum(weights), delta=0.02)
+
+    def test_pool_size_not_multiple_of_hosts(self):
+        self.assert_shares(3, [1, 2])
+        self.assert_shares(5, [1, 2])
+        self.assert_shares(7, [1, 1, 2])
+
+    def test_pool_size_less_than_hosts(self):
+        self.assertRaises(Exception, offline_pool, pool_size=1, hosts=2)
+        pool = offline_pool(pool_size=2, hosts=2)
+        self.assertRaises(Exception, pool.update, pool_size=1)
+        self.assertEqual(len(pool.pool), 2)
+
+
+class RestartTest(unittest.TestCase):
+
+    def test_start_all_drains_old_channels(self):
+        pool = offline_pool(pool_size=2, hosts=2, stub_cls=CompanyServerStub)
+        old = list(pool.pool)
+        channel = pool.get_one_connection()
+        channel.acquire()
+        pool.start_all(drain_timeout=5)
+        self.assertFalse(set(old) & set(pool.pool))
+        self.assertEqual(len(pool.pool), 2)
+        self.assertNotIn(channel, pick_many(pool))
+        time.sleep(0.1)
+        self.assertNotEqual(channel.state, "DEPRECATED")
+        channel.release()
+        deadline = time.monotonic() + 2
+        while any(c.state != "DEPRECATED" for c in old) and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual([c.state for c in old], ["DEPRECATED"] * 2)
+
+
+class WaiterTest(unittest.TestCase):
+
+    def test_use_release_wakes_waiters_in_order(self):
+        pool = offline_pool(pool_size=1, hosts=1, stub_cls=CompanyServerStub, checkout_timeout=5)
+        order = []
+
+        def worker(i):
+            channel = pool.get_one_connection()
+            with channel.use():
+                order.append(i)
+                time.sleep(0.01)
+
+        threads = []
+        with pool.get_one_connection().use():
+            for i in range(3):
+                thread = Thread(target=worker, args=(i,))
+                thread.start()
+                threads.append(thread)
+                while len(pool._waiters) <= i:
+                    time.sleep(0.001)
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(order, [0, 1, 2])
+        self.assertEqual(pool.wait_stats["timeout"], 0)
+
+
+class LatencyBalancerTest(unittest.TestCase):
+
+    def test_only_failure_codes_count_as_errors(self):
+        pool = offline_pool(pool_size=1, hosts=1, stub_cls=CompanyServerStub, balancer="latency")
+        channel = pool.get_one_connection()
+        for code in (StatusCode.OK, StatusCode.NOT_FOUND, StatusCode.INVALID_ARGUMENT):
+            channel.acquire()
+            channel.release(0.01, code is StatusCode.OK, code)
+        self.assertEqual(channel.error_ewma, 0.0)
+        channel.acquire()
+        channel.release(0.01, False, StatusCode.UNAVAILABLE)
+        self.assertGreater(channel.error_ewma, 0.0)
+
+
+class CoalesceTest(unittest.TestCase):
+
+    def run_flight(self, fn, followers=3):
+        flight = SingleFlight()
+        started = Event()
+        release = Event()
+        results = []
+
+        def leader_fn():
+            started.set()
+            release.wait(5)
+            return fn()
+
+        def call(f):
+            try:
+                results.append(flight.do("key", f, timeout=5)[0])
+            except Exception as e:
+                results.append(e)
+
+        leader = Thread(target=call, args=(leader_fn,))
+        leader.start()
+        started.wait(5)
+        threads = [Thread(target=call, args=(fn,)) for _ in range(followers)]
+        for thread in threads:
+            thread.start()
+        while flight.stats()["followers"] < followers:
+            time.sleep(0.001)
+        release.set()
+        for thread in [leader] + threads:
+            thread.join(5)
+        self.assertEqual(flight.stats(), {"leaders": 1, "followers": followers, "in_flight": 0})
+        return results
+
+    def test_followers_share_response(self):
+        calls = []
+        results = self.run_flight(lambda: calls.append(1) or "response")
+        self.assertEqual(calls, [1])
+        self.assertEqual(results, ["response"] * 4)
+
+    def test_followers_share_error(self):
+        def fail():
+            raise Unavailable()
+
+        results = self.run_flight(fail)
+        self.assertEqual(len(results), 4)
+        self.assertTrue(all(isinstance(r, Unavailable) for r in results))
+
+
+class BatchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.calls = []
+
+    def list_call(self, args, kwargs):
+        self.calls.append((args, kwargs))
+        keys = [Int32Value.FromString(item.value).value for item in args[0].filter]
+        return company_pb2.CompanyList(company=[company_pb2.Company(id=key, name="c%d" % key) for key in keys if key])
+
+    def test_fan_out(self):
+        batcher = MicroBatcher(self.list_call, window=0.5, max_batch=4)
+        results = {}
+
+        def submit(key):
+            try:
+                results[key] = batcher.submit(company_pb2.Company(id=key), timeout=5)
+            except Exception as e:
+                results[key] = e
+
+        threads = [Thread(target=submit, args=(key,)) for key in (1, 2, 2, 0)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(batcher.stats(), {"requests": 4, "batches": 1})
+        self.assertEqual(len(self.calls), 1)
+        self.assertEqual(results[1].name, "c1")
+        self.assertEqual(results[2].name, "c2")
+        self.assertIsInstance(results[0], NotFound)
+
+    def test_expired_deadline_fails_batch(self):
+        batcher = MicroBatcher(self.list_call)
+        batch = _Batch()
+        batch.slots = [_Slot(1), _Slot(2)]
+        batcher._flush(batch, company_pb2.Company(id=1), -0.001)
+        self.assertEqual(self.calls, [])
+        for slot in batch.slots:
+            self.assertIsInstance(slot.error, DeadlineExceeded)
+            self.assertTrue(slot.event.is_set())
+
+
+class RetryTest(unittest.TestCase):
+
+    def failing_pool(self, hosts, **kwargs):
+        pool = offline_pool(pool_size=hosts, hosts=hosts, stub_cls=CompanyServerStub, **kwargs)
+        attempts = []
+        for channel in pool.pool:
+            def fail(request, timeout=None, metadata=None, port=channel.port):
+                attempts.append(port)
+                raise Unavailable()
+            channel.stub_methods["RetrieveCompany"] = fail
+        return pool, attempts
+
+    def test_retry_avoids_failed_hosts(self):
+        pool, attempts = self.failing_pool(3, retry={"RetrieveCompany": {"max_attempts": 3, "backoff": 0}},
+                                           retry_budget={"ratio": 2, "max_tokens": 2})
+        for _ in range(20):
+            del attempts[:]
+            self.assertRaises(Unavailable, pool.RetrieveCompany, None)
+            self.assertEqual(len(set(attempts)), 3)
+
+    def test_retry_budget_exhausted(self):
+        pool, attempts = self.failing_pool(2, retry={"RetrieveCompany": {"max_attempts": 3, "backoff": 0}},
+                                           retry_budget={"ratio": 0, "max_tokens": 2})
+        self.assertRaises(Unavailable, pool.RetrieveCompany, None)
+        self.assertRaises(Unavailable, pool.RetrieveCompany, None)
+        self.assertEqual(len(attempts), 4)
+        stats = pool.retry_stats()["methods"]["RetrieveCompany"]
+        self.assertEqual(stats, {"retries": 2, "exhausted": 1, "throttled": 1})
+
+
+class MetricsTest(unittest.TestCase):
+
+    def test_checkout_wait_records_every_checkout(self):
+        pool = offline_pool(pool_size=1, hosts=1, stub_cls=CompanyServerStub, metrics=True)
+        channel = pool.get_one_connection()
+        with channel.use():
+            self.assertRaises(BlockingIOError, pool.get_one_connection)
+        for _ in range(8):
+            pool.get_one_connection()
+        checkout = pool.metrics.snapshot()["checkout"]
+        self.assertEqual(checkout["count"], 10)
+        self.assertEqual(checkout["buckets"][0][1], 10)
+
+
+class LazyManager(BenchManager):
+    methods = {}
+    routes = {}
+    ambiguous_methods = set()
+    pools = set()
+
+
+def write_config(text):
+    f = tempfile.NamedTemporaryFile("w", suffix=".yaml", delete=False)
+    with f:
+        f.write(text)
+    return f.name
+
+
+class ManagerTest(unittest.TestCase):
+
+    def test_lazy_private_names_do_not_import_stubs(self):
+        path = write_config("""
+lazy: true
+manager:
+  - servers:
+      - {host: "127.0.0.1", port: 9100}
+    stub: "package_that_does_not_exist.Stub"
+""")
+        try:
+            manager = LazyManager(config=path)
+            self.assertFalse(hasattr(manager, "__deepcopy__"))
+            self.assertFalse(hasattr(manager, "_repr_html_"))
+            self.assertEqual(len(manager.pending_pools), 1)
+            self.assertRaises(ImportError, getattr, manager, "GetAllCompany")
+        finally:
+            os.unlink(path)
+
+
+class ReloadTest(unittest.TestCase):
+
+    def setUp(self):
+        self.manager = type("ReloadManager", (BenchManager,), {
+            "methods": {}, "routes": {}, "ambiguous_methods": set(), "pools": set(), "pool_cls": OfflinePool})()
+        self.paths = []
+
+    def tearDown(self):
+        for pool in list(self.manager.pools):
+            pool.close_all()
+        for path in self.paths:
+            os.unlink(path)
+
+    def load(self, pools):
+        text = "manager:\n"
+        for name, servers, size, extra in pools:
+            text += "  - name: %s\n    stub: %s.CompanyServerStub\n    size: %d\n    servers:\n" % (
+                name, CompanyServerStub.__module__, size)
+            for port, weight in servers:
+                text += "      - {host: 127.0.0.1, port: %d, weight: %d}\n" % (port, weight)
+            text += extra
+        self.paths.append(write_config(text))
+        if self.manager.config is None:
+            type(self.manager)(config=self.paths[-1])
+            return None
+        return self.manager.reload(self.paths[-1], drain_timeout=0)
+
+    def test_reload_diff(self):
+        self.load([("a", [(9100, 1), (9101, 1)], 2, ""), ("b", [(9102, 1)], 1, "")])
+        a = self.manager.config_pools["a"]
+        kept = [c for c in a.pool if c.port == 9100][0]
+        result = self.load([("a", [(9100, 1), (9103, 3)], 2, ""), ("c", [(9104, 1)], 1, "")])
+        self.assertEqual(result, {"added": ["c"], "removed": ["b"], "updated": ["a"], "replaced": []})
+        self.assertIs(self.manager.config_pools["a"], a)
+        self.assertIn(kept, a.pool)
+        self.assertEqual(sorted(c.port for c in a.pool), [9100, 9103])
+        self.assertEqual(sorted(self.manager.config_pools), ["a", "c"])
+
+    def test_reload_unchanged_and_replaced(self):
+        self.load([("a", [(9100, 1)], 1, "")])
+        a = self.manager.config_pools["a"]
+        result = self.load([("a", [(9100, 1)], 1, "")])
+        self.assertEqual(result, {"added": [], "removed": [], "updated": [], "replaced": []})
+        result = self.load([("a", [(9100, 1)], 1, "    default_timeout: 1\n")])
+        self.assertEqual(result["replaced"], ["a"])
+        self.assertIsNot(self.manager.config_pools["a"], a)
+        self.assertNotIn(a, self.manager.pools)
+
+
+class AsyncPoolTest(unittest.TestCase):
+
+    def test_unsupported_calls_raise_type_error(self):
+        async def run():
+            pool = AsyncClientConnectionPool(port=9100, pool_size=1, stub_cls=CompanyServerStub)
+            dispatcher = pool.dispatcher("GetAllCompany")
+            self.assertRaises(TypeError, dispatcher.with_call, None)
+            self.assertRaises(TypeError, dispatcher.future, None)
+            self.assertRaises(TypeError, pool.broadcast, "GetAllCompany", None)
+            await pool.aclose_all()
+
+        asyncio.run(run())
+
+    def test_channels_closed_with_loop(self):
+        pool = AsyncClientConnectionPool(port=9100, pool_size=2, stub_cls=CompanyServerStub)
+
+        async def run():
+            pool.get_one_connection()
+            self.assertTrue(all(c.grpc_channel is not None for c in pool.pool))
+
+        for _ in range(2):
+            asyncio.run(run())
+            self.assertEqual([c.grpc_channel for c in pool.pool], [None, None])
+            self.assertEqual([c.stub for c in pool.pool], [None, None])
+
+    def test_sync_call_chain_options_rejected(self):
+        for option in ("cache", "coalesce", "batch", "retry", "hedge"):
+            self.assertRaises(Exception, AsyncClientConnectionPool, port=9100, pool_size=1,
+                              stub_cls=CompanyServerStub, **{option: {"GetAllCompany": {}}})
+
+
+def main():
+    pool = ClientConnectionPool(stub_cls=CompanyServerStub)
+
+    manager = Manager(config="config.yaml")
+    print(manager.methods)
+    print(manager.pools)
+    from google.protobuf.empty_pb2 import Empty
+
+    for i in range(10):
+        r = manager.GetAllCompany(Empty())
+        # print(r)
+
+
+if __name__ == '__main__':
+    main()
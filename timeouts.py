@@ -0,0 +1,65 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+from time import monotonic
+
+from .errors import DeadlineExceeded
+
+# 当前上下文(线程/协程)的截止时间，monotonic时间
+_current_deadline = ContextVar("grpc_client_pool_deadline", default=None)
+
+
+@contextmanager
+def deadline(timeout):
+    """
+    在with块中设置截止时间，块内通过连接池发出的请求的timeout不会超过剩余时间
+    嵌套时取更早的截止时间，如在服务端处理请求时: with deadline(context.time_remaining()): ...
+    :param timeout: 剩余时间(秒)，为None时不改变当前的截止时间
+    :return:
+    """
+    current = _current_deadline.get()
+    if timeout is not None:
+        new = monotonic() + timeout
+        if current is None or new < current:
+            current = new
+    token = _current_deadline.set(current)
+    try:
+        yield current
+    finally:
+        _current_deadline.reset(token)
+
+
+def remaining():
+    """
+    当前上下文的剩余时间(秒)，没有设置截止时间时返回None
+    :return:
+    """
+    current = _current_deadline.get()
+    if current is None:
+        return None
+    return current - monotonic()
+
+
+def apply_deadline(kwargs, default=None):
+    """
+    计算一次调用的timeout: 调用时传入的timeout或默认值，且不超过当前上下文的剩余时间
+    :param kwargs: 调用参数
+    :param default: 方法或连接池的默认超时时间(秒)
+    :return: 新的调用参数，已经超过截止时间时抛出DeadlineExceeded
+    """
+    current = _current_deadline.get()
+    if current is None and default is None:
+        return kwargs
+    timeout = kwargs.get("timeout")
+    if timeout is None:
+        timeout = default
+    if current is not None:
+        left = current - monotonic()
+        if left <= 0:
+            raise DeadlineExceeded("Deadline Exceeded before the call was sent")
+        if timeout is None or left < timeout:
+            timeout = left
+    if timeout is None:
+        return kwargs
+    kwargs = dict(kwargs)
+    kwargs["timeout"] = timeout
+    return kwargs
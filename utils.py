@@ -1,29 +1,185 @@
-from random import randint
+from bisect import bisect_right
+from itertools import accumulate
+from random import random
+from threading import Lock
 
 
 def weight_random(objects, key="weight"):
-    _sum = 0
-    temp = []
-    o = list(objects)
-    for obj in objects:
-        w = getattr(obj, key, 0)
-        if w:
-            _sum += w
-            temp.append(_sum)
+    """
+    按权重随机选取一个对象，权重为0的对象不会被选中
+    :param objects: 待选对象
+    :param key: 权重属性名
+    :return:
+    """
+    o = [obj for obj in objects if getattr(obj, key, 0) > 0]
+    if not o:
+        return None
+    temp = list(accumulate(getattr(obj, key) for obj in o))
+    return o[bisect_right(temp, random() * temp[-1])]
 
-    rand = randint(0, _sum)
-    for i in range(len(objects)):
-        if temp[i] >= rand:
-            return o[i]
+
+class _MethodRecorder(object):
+    """
+    代替grpc channel传给stub的构造函数，记录每个方法的完整路径
+    """
+
+    def unary_unary(self, method, *args, **kwargs):
+        return "unary_unary", method
+
+    def unary_stream(self, method, *args, **kwargs):
+        return "unary_stream", method
+
+    def stream_unary(self, method, *args, **kwargs):
+        return "stream_unary", method
+
+    def stream_stream(self, method, *args, **kwargs):
+        return "stream_stream", method
+
+
+_method_paths = {}
+
+
+def stub_method_paths(stub_cls):
+    """
+    获取stub类中每个方法的完整路径，如 {"GetAllCompany": "/CompanyServer/GetAllCompany"}
+    :param stub_cls: grpc生成的stub类
+    :return:
+    """
+    paths = _method_paths.get(stub_cls)
+    if paths is None:
+        paths = {}
+        try:
+            stub = stub_cls(_MethodRecorder())
+        except Exception:
+            stub = None
+        if stub is not None:
+            for k, v in stub.__dict__.items():
+                if isinstance(v, tuple) and len(v) == 2:
+                    paths[k] = v[1]
+        _method_paths[stub_cls] = paths
+    return paths
+
+
+class AliasTable(object):
+    """
+    Vose alias表，构建O(n)，每次按权重选取O(1)
+    """
+
+    def __init__(self, objects=(), key="weight"):
+        self.items = []
+        self._prob = []
+        self._alias = []
+        self.build(objects, key)
+
+    def build(self, objects, key="weight"):
+        """
+        根据对象的权重重建alias表，权重为0的对象会被剔除
+        :param objects: 待选对象
+        :param key: 权重属性名
+        :return:
+        """
+        items = []
+        weights = []
+        for obj in objects:
+            w = getattr(obj, key, 0)
+            if w and w > 0:
+                items.append(obj)
+                weights.append(float(w))
+
+        n = len(items)
+        prob = [0.0] * n
+        alias = [0] * n
+        if n:
+            total = sum(weights)
+            scaled = [w * n / total for w in weights]
+            small = [i for i, w in enumerate(scaled) if w < 1.0]
+            large = [i for i, w in enumerate(scaled) if w >= 1.0]
+            while small and large:
+                s = small.pop()
+                l = large.pop()
+                prob[s] = scaled[s]
+                alias[s] = l
+                scaled[l] = scaled[l] + scaled[s] - 1.0
+                if scaled[l] < 1.0:
+                    small.append(l)
+                else:
+                    large.append(l)
+            for i in large + small:
+                prob[i] = 1.0
+
+        self.items = items
+        self._prob = prob
+        self._alias = alias
+
+    def pick(self):
+        """
+        按权重随机选取一个对象，表为空时返回None
+        :return:
+        """
+        items = self.items
+        if not items:
+            return None
+        r = random() * len(items)
+        i = int(r)
+        if r - i < self._prob[i]:
+            return items[i]
+        return items[self._alias[i]]
+
+    def __len__(self):
+        return len(self.items)
+
+
+class TokenBucket(object):
+    """
+    按正常请求的比例积累令牌，额外的请求(重试、对冲)需要消耗一个令牌，防止故障时放大负载
+    """
+
+    def __init__(self, ratio=0.1, max_tokens=10):
+        """
+        :param ratio: 每个正常请求积累的令牌数，即额外请求最多占正常请求的比例
+        :param max_tokens: 令牌上限，也是初始令牌数
+        """
+        self.ratio = ratio
+        self.max_tokens = max_tokens
+        self.tokens = float(max_tokens)
+        self._lock = Lock()
+        self.granted = 0
+        self.denied = 0
+
+    def deposit(self):
+        """
+        记录一个正常请求
+        :return:
+        """
+        with self._lock:
+            self.tokens = min(self.tokens + self.ratio, self.max_tokens)
+
+    def withdraw(self):
+        """
+        消耗一个令牌
+        :return: 令牌不足时返回False
+        """
+        with self._lock:
+            if self.tokens < 1:
+                self.denied += 1
+                return False
+            self.tokens -= 1
+            self.granted += 1
+            return True
+
+    def stats(self):
+        with self._lock:
+            return {"tokens": self.tokens, "granted": self.granted, "denied": self.denied}
 
 
 if __name__ == '__main__':
     class O:
         def __init__(self, w):
-            self.weights = w
+            self.weight = w
 
 
     a = O(1)
     d = O(0)
 
-    print(weight_random([a, d]).weights)
+    print(weight_random([a, d]).weight)
+    print(AliasTable([a, d]).pick().weight)